@@ -0,0 +1,92 @@
+from datetime import date
+import numpy as np
+import pandas as pd
+
+TRADING_DAYS_PER_YEAR = 252
+
+def parse_buy_date(buy_date):
+    """
+    Returns the date a lot was bought, buy dates are saved as YYYY-MM-DD or YYYY/MM/DD strings
+    """
+    return date.fromisoformat(buy_date.replace('/', '-'))
+
+def load_prices(tags, history, start, end):
+    """
+    Returns a DataFrame of closing prices indexed by date with one column per tag, read from history
+    (a price_history.PriceHistory or anything with the same get_bars method). history is only read, nothing
+    missing from it is fetched. Days a tag didn't trade carry its previous close forward, and days before a tag's
+    first stored bar use that bar.
+    """
+    closes = {}
+    for tag in tags:
+        bars = history.get_bars(tag, start, end, fetch=False)
+        closes[tag] = pd.Series(np.asarray(bars['close']), index=np.asarray(bars['date']))
+    prices = pd.DataFrame(closes, columns=list(tags)).sort_index().ffill().bfill()
+    prices.index = pd.to_datetime([date.fromordinal(int(day)) for day in prices.index])
+    return prices
+
+def holdings_matrix(portfolio, tags, dates):
+    """
+    Returns a (dates x tags) array of how many shares of each tag were held at the end of each day,
+    built from the buy dates of each position's lots.
+    """
+    day_numbers = np.array([day.toordinal() for day in dates.date], dtype=np.int64)
+    holdings = np.zeros((len(dates), len(tags)))
+    for i, tag in enumerate(tags):
+        lots = portfolio[tag].lots
+        lot_days = np.fromiter((parse_buy_date(lot.buy_date).toordinal() for lot in lots), dtype=np.int64, count=len(lots))
+        lot_quantities = np.fromiter((lot.quantity for lot in lots), dtype=float, count=len(lots))
+        order = np.argsort(lot_days, kind='stable')
+        held = np.concatenate([[0], np.cumsum(lot_quantities[order])])
+        holdings[:, i] = held[np.searchsorted(lot_days[order], day_numbers, 'right')]
+    return holdings
+
+def analyze_portfolio(portfolio, history, start, end, benchmark=None):
+    """
+    Computes the performance of the positions currently in portfolio between the start and end dates from stored
+    price history. Shares are counted from the day their lot was bought. Cash isn't tracked historically, so
+    everything is measured on the invested value, treating purchases as flows into the portfolio.
+    Nothing is fetched, so history should be backfilled first. Tags with no stored bars are valued at 0.
+
+    Returns a dictionary:
+    {"VALUE": daily invested value (Series), "RETURNS": daily time weighted returns (Series),
+     "TIME_WEIGHTED_RETURN": total return, "VOLATILITY": annualized volatility of the daily returns,
+     "MAX_DRAWDOWN": largest fall from a peak as a negative fraction, "BETA": beta against the benchmark tag
+     (None without one), "CONTRIBUTION": {tag: share of the total return earned by that position}}
+    """
+    tags = list(portfolio.position_index)
+    # the benchmark may also be one of the positions, each tag is loaded once
+    prices = load_prices(list(dict.fromkeys(tags + ([benchmark] if benchmark else []))), history, start, end)
+    dates = prices.index
+    price_matrix = prices[tags].to_numpy(dtype=float)
+    holdings = holdings_matrix(portfolio, tags, dates)
+    # tags without any stored history can't be valued
+    price_matrix = np.nan_to_num(price_matrix)
+
+    values = holdings * price_matrix
+    total_value = values.sum(axis=1)
+    # money put into each position on each day, bought at that day's close
+    flows = np.diff(holdings, axis=0, prepend=0) * price_matrix
+    gains = np.diff(values, axis=0, prepend=0) - flows
+    previous_value = np.concatenate([[0], total_value[:-1]])
+    invested = previous_value > 0
+    returns = np.where(invested, gains.sum(axis=1) / np.where(invested, previous_value, 1), 0)
+
+    growth = np.cumprod(1 + returns)
+    drawdowns = growth / np.maximum.accumulate(growth) - 1 if len(growth) else growth
+    contributions = (gains / np.where(invested, previous_value, 1)[:, None])[invested].sum(axis=0) if len(tags) else []
+
+    beta = None
+    if benchmark:
+        benchmark_returns = prices[benchmark].pct_change().fillna(0).to_numpy()
+        active = invested & np.isfinite(benchmark_returns)
+        if active.sum() > 1 and np.var(benchmark_returns[active]) > 0:
+            beta = float(np.cov(returns[active], benchmark_returns[active])[0, 1] / np.var(benchmark_returns[active], ddof=1))
+
+    return {"VALUE": pd.Series(total_value, index=dates),
+            "RETURNS": pd.Series(returns, index=dates),
+            "TIME_WEIGHTED_RETURN": float(growth[-1] - 1) if len(growth) else 0.0,
+            "VOLATILITY": float(returns[invested].std(ddof=1) * np.sqrt(TRADING_DAYS_PER_YEAR)) if invested.sum() > 1 else 0.0,
+            "MAX_DRAWDOWN": float(drawdowns.min()) if len(drawdowns) else 0.0,
+            "BETA": beta,
+            "CONTRIBUTION": dict(zip(tags, map(float, contributions)))}
@@ -0,0 +1,140 @@
+import time
+from collections import namedtuple
+from datetime import timedelta
+import numpy as np
+
+import stock_scrape
+from stocks import Portfolio
+
+# one dated instruction, action is 'BUY' or 'SELL'
+Trade = namedtuple('Trade', ['date', 'action', 'tag', 'quantity'])
+# calendar days before the first trade read from history, so a trade on a weekend or holiday has a close to use
+LOOKBACK_DAYS = 7
+
+def load_closes(tags, history, start, end):
+    """
+    Returns a dictionary mapping each tag to a tuple of (date ordinals, closing prices) of its stored bars.
+    history is a price_history.PriceHistory or anything with the same get_bars method, and is only read,
+    nothing missing from it is fetched.
+    """
+    closes = {}
+    for tag in tags:
+        bars = history.get_bars(tag, start, end, fetch=False)
+        known = ~np.isnan(np.asarray(bars['close']))
+        closes[tag] = (np.asarray(bars['date'])[known], np.asarray(bars['close'])[known])
+    return closes
+
+def close_on(closes, tag, day):
+    """
+    Returns the last close of tag on or before day (a date), or nan if none is stored
+    """
+    dates, prices = closes[tag]
+    i = np.searchsorted(dates, day.toordinal(), 'right') - 1
+    return float(prices[i]) if i >= 0 else np.nan
+
+def prepare(portfolio, trades, history, end):
+    """
+    Returns the trades sorted by date, the order they were sorted in, the price of each trade and the
+    price of every tag at the end of the replay. Tags without a price at the end keep their last known price.
+    """
+    order = sorted(range(len(trades)), key=lambda i: trades[i].date)
+    trades = [trades[i] for i in order]
+    tags = list(dict.fromkeys(list(portfolio.position_index) + [trade.tag for trade in trades]))
+    if end is None:
+        end = trades[-1].date if trades else stock_scrape.today().date()
+    start = (trades[0].date if trades else end) - timedelta(LOOKBACK_DAYS)
+    closes = load_closes(tags, history, start, end)
+    prices = np.array([close_on(closes, trade.tag, trade.date) for trade in trades], dtype=float)
+    end_prices = {}
+    for tag in tags:
+        price = close_on(closes, tag, end)
+        if np.isnan(price):
+            price = (portfolio[tag].current_price or 0) if tag in portfolio else 0
+        end_prices[tag] = price
+    return trades, order, prices, end_prices
+
+def replay(portfolio, trades, history, end=None):
+    """
+    Replays trades (a list of Trade) on a copy of portfolio with Portfolio.buy_shares and sell_shares, at the close of
+    each trade's day from history, and returns the copy valued at the close on end (the last trade's day by default).
+    Trades the trade screen wouldn't allow, buying more than the cash covers or selling more shares than are owned,
+    are skipped, as are trades on days with no stored price.
+    """
+    trades, _, prices, end_prices = prepare(portfolio, trades, history, end)
+    portfolio = Portfolio.load_portfolio(portfolio.get_save_dict())
+    for trade, price in zip(trades, prices):
+        if np.isnan(price) or trade.quantity <= 0:
+            continue
+        if trade.action == 'BUY':
+            if trade.quantity * price <= portfolio.cash:
+                portfolio.buy_shares(trade.tag, trade.quantity, float(price), stock_scrape.get_date_str(trade.date))
+        elif trade.tag in portfolio and trade.quantity <= portfolio[trade.tag].num_shares:
+            portfolio.sell_shares(trade.tag, trade.quantity, float(price))
+    for tag in list(portfolio.position_index):
+        portfolio.apply_price(tag, end_prices[tag], 0)
+    return portfolio
+
+def simulate(portfolio, trades, history, quantities=None, end=None):
+    """
+    Replays trades against portfolio like replay() for many strategy variants at once. quantities is a
+    (variants x trades) array giving the number of shares each variant trades for each instruction, a quantity of 0
+    skips the instruction. By default there is one variant trading the quantities of the trades.
+
+    Each variant's lots are kept as a row of a matrix per tag with one column per lot in the order they were bought,
+    so every trade is applied to all of the variants with a few array operations and shares are sold oldest first
+    just like Position.remove_shares.
+
+    Returns a dictionary of arrays with one value per variant:
+    {"CASH": array, "MARKET_VALUE": array, "CURRENT_VALUE": array, "TOTAL_COST_BASIS": array,
+     "TOTAL_GAIN_LOSS": array, "SKIPPED": number of trades skipped, "SHARES": {tag: shares held},
+     "ELAPSED": seconds taken, "TRADES_PER_SECOND": trades simulated per second across all variants}
+    """
+    start_time = time.perf_counter()
+    if quantities is None:
+        quantities = [[trade.quantity for trade in trades]]
+    quantities = np.array(quantities, dtype=float, ndmin=2)
+    if quantities.shape[1] != len(trades):
+        raise ValueError(f'quantities has {quantities.shape[1]} columns for {len(trades)} trades')
+    trades, order, prices, end_prices = prepare(portfolio, trades, history, end)
+    quantities = quantities[:, order]
+    variants = len(quantities)
+
+    # one column for each lot already held, then one for each buy
+    lots, costs, next_column = {}, {}, {}
+    for tag in end_prices:
+        held = list(portfolio[tag].lots) if tag in portfolio else []
+        buys = sum(trade.action == 'BUY' and trade.tag == tag for trade in trades)
+        lots[tag] = np.zeros((variants, len(held) + buys))
+        lots[tag][:, :len(held)] = [lot.quantity for lot in held]
+        costs[tag] = np.zeros(len(held) + buys)
+        costs[tag][:len(held)] = [lot.cost_basis for lot in held]
+        next_column[tag] = len(held)
+
+    cash = np.full(variants, float(portfolio.cash))
+    skipped = np.zeros(variants, dtype=int)
+    for i, (trade, price) in enumerate(zip(trades, prices)):
+        quantity = quantities[:, i]
+        remaining = lots[trade.tag]
+        if trade.action == 'BUY':
+            allowed = (quantity > 0) & (quantity * price <= cash)
+            column = next_column[trade.tag]
+            next_column[trade.tag] += 1
+            remaining[:, column] = np.where(allowed, quantity, 0)
+            costs[trade.tag][column] = np.nan_to_num(price)
+            cash -= np.where(allowed, quantity * price, 0)
+        else:
+            allowed = (quantity > 0) & (quantity <= remaining.sum(axis=1)) & ~np.isnan(price)
+            sold = np.where(allowed, quantity, 0)
+            # the sold shares are taken from the oldest lots first, each lot keeps what's left after the lots before it
+            remaining[:] = np.minimum(remaining, np.maximum(np.cumsum(remaining, axis=1) - sold[:, None], 0))
+            cash += np.where(allowed, quantity * price, 0)
+        skipped += ~allowed & (quantity > 0)
+
+    shares = {tag: remaining.sum(axis=1) for tag, remaining in lots.items()}
+    market_value = sum((shares[tag] * end_prices[tag] for tag in lots), np.zeros(variants))
+    cost_basis = sum((lots[tag] @ costs[tag] for tag in lots), np.zeros(variants))
+    elapsed = time.perf_counter() - start_time
+    return {"CASH": cash, "MARKET_VALUE": market_value, "CURRENT_VALUE": market_value + cash,
+            "TOTAL_COST_BASIS": cost_basis, "TOTAL_GAIN_LOSS": market_value + cash - portfolio.initial_value,
+            "SKIPPED": skipped, "SHARES": shares, "ELAPSED": elapsed,
+            "TRADES_PER_SECOND": variants * len(trades) / elapsed if elapsed else 0.0}
@@ -0,0 +1,266 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+import numpy as np
+from pytz import timezone
+from bs4 import BeautifulSoup
+
+import analytics
+import backtest
+import stock_scrape
+from symbol_index import SymbolIndex
+from price_history import BAR_DTYPE, PriceHistory, SQLiteHistoryBackend, MemmapHistoryBackend
+from stocks import Portfolio, Position
+
+# recorded stock history pages checked by the pages benchmark when no paths are given
+FIXTURE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def measure(func, *args, repeat=10):
+    """
+    Runs func(*args) repeat times and returns a tuple containing the result, the average time in seconds and
+    the peak memory in bytes used by one call.
+    """
+    tracemalloc.start()
+    result = func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(*args)
+    return result, (time.perf_counter() - start) / repeat, peak
+
+def report(name, fast_time, slow_time, fast_peak=None, slow_peak=None):
+    """
+    Prints a line comparing the new implementation of something to the old one
+    """
+    line = f'{name}: {slow_time * 1000:,.2f}ms -> {fast_time * 1000:,.2f}ms ({slow_time / fast_time:,.1f}x faster)'
+    if fast_peak is not None:
+        line += f', peak memory {slow_peak / 1024:,.0f}KB -> {fast_peak / 1024:,.0f}KB'
+    print(line)
+
+def legacy_parse_stock_page(source):
+    """
+    The original full tree parse of a stock page, kept to check the targeted parser against it.
+    Returns the price text and the (date, close price) rows.
+    """
+    soup = BeautifulSoup(source, 'lxml')
+    out = []
+    close_price_index = 4
+    _timezone = timezone('GMT')
+    for row in soup.find('table').find_all('tr'):
+        row_str = [elm.text for elm in row.find_all('span')]
+        if 'Close' in row_str:
+            close_price_index = row_str.index('Close')
+        try:
+            _date = _timezone.localize(datetime.strptime(row_str[0], '%b %d, %Y'))
+            out.append((_date, float(row_str[close_price_index].replace(',', ''))))
+        except Exception as e:
+            continue
+    price = soup.find('span', attrs={"data-reactid": "50"})
+    return price.text if price else None, out
+
+def bench_page_parse(paths):
+    """
+    Parses each recorded stock page (an html file saved from the history page) with the old and the new parser,
+    checks they agree and compares their speed and peak memory. Uses the pages in FIXTURE_DIRECTORY by default.
+    """
+    if not paths:
+        paths = sorted(os.path.join(FIXTURE_DIRECTORY, name) for name in os.listdir(FIXTURE_DIRECTORY)
+                       if name.endswith('.html'))
+    for path in paths:
+        with open(path, encoding='utf-8') as page_file:
+            source = page_file.read()
+        (old_price, old_rows), old_time, old_peak = measure(legacy_parse_stock_page, source)
+        page, new_time, new_peak = measure(stock_scrape.parse_stock_page, source)
+        assert old_rows == [(row.date, row.close) for row in page.history], f'history rows differ for {path}'
+        assert (old_price is None and page.price is None) or float(old_price.replace(',', '')) == page.price, \
+            f'price differs for {path}'
+        report(f'parse {path}', new_time, old_time, new_peak, old_peak)
+
+def make_portfolio(num_positions, num_lots, lot_size):
+    """
+    Builds a portfolio of made up positions without fetching any prices
+    """
+    portfolio = Portfolio('Benchmark', 10000)
+    for i in range(num_positions):
+        position = Position(f'T{i}')
+        for j in range(num_lots):
+            position.add_share(100 + j, f'2021/03/{j % 28 + 1:02d}', lot_size)
+        portfolio.add_position(position)
+    return portfolio
+
+def legacy_save_dict(portfolio):
+    """
+    The version 1 save format, one dictionary per share
+    """
+    data = portfolio.get_save_dict()
+    data['POSITIONS'] = [{'TAG': position.tag, 'NUM_SHARES': position.num_shares,
+                          'TOTAL_COST_BASIS': position.total_cost_basis,
+                          'SHARES': [share.get_save_dict() for share in position.shares]}
+                         for position in portfolio.positions]
+    del data['VERSION']
+    return data
+
+def bench_portfolio_io(args):
+    """
+    Compares saving and loading a portfolio in the version 1 per share format and the current columnar format.
+    args are the number of positions, lots per position and shares per lot.
+    """
+    num_positions, num_lots, lot_size = (int(arg) for arg in args) if args else (30, 20, 50)
+    portfolio = make_portfolio(num_positions, num_lots, lot_size)
+    save_old = lambda: json.dumps(legacy_save_dict(portfolio))
+    save_new = lambda: json.dumps(portfolio.get_save_dict())
+    old_source, old_save, _ = measure(save_old)
+    new_source, new_save, _ = measure(save_new)
+    load = lambda source: Portfolio.load_portfolio(json.loads(source))
+    old_loaded, old_load, _ = measure(load, old_source)
+    new_loaded, new_load, _ = measure(load, new_source)
+    assert old_loaded.get_save_dict()['POSITIONS'] == new_loaded.get_save_dict()['POSITIONS'] == \
+        portfolio.get_save_dict()['POSITIONS'], 'loaded portfolios differ'
+    print(f'{num_positions} positions x {num_lots} lots x {lot_size} shares, '
+          f'file size {len(old_source):,} -> {len(new_source):,} bytes')
+    report('save', new_save, old_save)
+    report('load', new_load, old_load)
+
+class SyntheticHistory():
+    """
+    Made up daily bars for any tag, standing in for a price_history.PriceHistory without network or disk
+    """
+    def __init__(self, seed=0):
+        self.seed = seed
+
+    def get_bars(self, tag, start, end, fetch=True):
+        days = np.arange(start.toordinal(), end.toordinal() + 1)
+        days = days[[date.fromordinal(int(day)).weekday() < 5 for day in days]]
+        random = np.random.default_rng(abs(hash((tag, self.seed))) % 2 ** 32)
+        bars = np.zeros(len(days), dtype=BAR_DTYPE)
+        bars['date'] = days
+        bars['close'] = 100 * np.cumprod(1 + random.normal(0, .01, len(days)))
+        return bars
+
+def bench_analytics(args):
+    """
+    Times analytics.analyze_portfolio over a year of made up history. args are the number of positions and lots.
+    """
+    num_positions, num_lots = (int(arg) for arg in args) if args else (40, 10)
+    end = date(2021, 3, 1)
+    start = end - timedelta(365)
+    portfolio = Portfolio('Benchmark', 10000)
+    for i in range(num_positions):
+        position = Position(f'T{i}')
+        for j in range(num_lots):
+            position.add_share(100, str(start + timedelta(j * 30 + i)), 10)
+        portfolio.add_position(position)
+    history = SyntheticHistory()
+    result, elapsed, _ = measure(analytics.analyze_portfolio, portfolio, history, start, end, 'SPY')
+    print(f'{num_positions} positions x {len(result["VALUE"])} days analyzed in {elapsed * 1000:,.2f}ms: '
+          f'return {result["TIME_WEIGHTED_RETURN"]:+.2%}, volatility {result["VOLATILITY"]:.2%}, '
+          f'max drawdown {result["MAX_DRAWDOWN"]:.2%}, beta {result["BETA"]:.2f}')
+
+def bench_backtest(args):
+    """
+    Replays made up trades over a year of made up history for many variants at once and checks the first variant
+    against replaying it through Portfolio. args are the number of variants, trades and tags.
+    """
+    num_variants, num_trades, num_tags = (int(arg) for arg in args) if args else (500, 250, 20)
+    start = date(2020, 3, 2)
+    random = np.random.default_rng(0)
+    trades = [backtest.Trade(start + timedelta(int(day)), 'BUY' if buy else 'SELL', f'T{tag}', 5)
+              for day, buy, tag in zip(np.sort(random.integers(0, 365, num_trades)), random.random(num_trades) < .6,
+                                       random.integers(0, num_tags, num_trades))]
+    quantities = random.integers(0, 20, (num_variants, num_trades))
+    portfolio = Portfolio('Benchmark', 100000)
+    history = SyntheticHistory()
+    result, elapsed, _ = measure(backtest.simulate, portfolio, trades, history, quantities, repeat=3)
+    variant = [trade._replace(quantity=int(quantity)) for trade, quantity in zip(trades, quantities[0])]
+    replayed, replay_time, _ = measure(backtest.replay, portfolio, variant, history, repeat=3)
+    assert np.isclose(replayed.current_value, result['CURRENT_VALUE'][0]) and \
+        np.isclose(replayed.total_cost_basis, result['TOTAL_COST_BASIS'][0]), 'simulated variant differs from replay'
+    print(f'{num_variants} variants x {num_trades} trades in {elapsed * 1000:,.2f}ms, '
+          f'{num_variants * num_trades / elapsed:,.0f} trades/s, {result["SKIPPED"].sum():,} skipped')
+    report('per variant', elapsed / num_variants, replay_time)
+
+def bench_backfill(args):
+    """
+    Backfills a year of history for a tag listed partway through it from a made up scraper on both history backends,
+    checking the days before the listing are covered rather than failed so nothing is fetched again.
+    args are the listing date and the start and end of the range as YYYY-MM-DD.
+    """
+    listed, start, end = (date.fromisoformat(arg) for arg in args) if args else \
+        (date(2024, 6, 3), date(2024, 1, 1), date(2024, 12, 31))
+    fetches = []
+    def get_history_scrape(tag, chunk_start, chunk_end):
+        fetches.append((chunk_start, chunk_end))
+        days = [chunk_start + timedelta(i) for i in range((chunk_end - chunk_start).days + 1)]
+        return [stock_scrape.HistoryRow(datetime.combine(day, datetime.min.time()), 10, 10, 10, 10, 100)
+                for day in reversed(days) if day >= listed and day.weekday() < 5]
+    directory = tempfile.mkdtemp()
+    scrape = stock_scrape.get_history_scrape
+    stock_scrape.get_history_scrape = get_history_scrape
+    try:
+        for backend in (SQLiteHistoryBackend(os.path.join(directory, 'history.db')),
+                        MemmapHistoryBackend(os.path.join(directory, 'bars'))):
+            history = PriceHistory(backend)
+            for attempt in range(3):
+                fetches.clear()
+                start_time = time.perf_counter()
+                bars = history.get_bars('NEW', start, end)
+                elapsed = time.perf_counter() - start_time
+                assert backend.get_coverage('NEW') == (start.toordinal(), end.toordinal()), 'days before listing not covered'
+                assert attempt == 0 or not fetches, 'covered days fetched again'
+                print(f'{type(backend).__name__} call {attempt + 1}: {len(fetches)} fetches, {len(bars)} bars '
+                      f'in {elapsed * 1000:,.2f}ms')
+            history.get_bars('NEW', start - timedelta(365), end)
+            assert not fetches and backend.get_coverage('NEW')[0] == (start - timedelta(365)).toordinal(), \
+                'days before listing fetched again'
+            history.close()
+    finally:
+        stock_scrape.get_history_scrape = scrape
+        shutil.rmtree(directory)
+
+def bench_symbols(args):
+    """
+    Compares parsing symbols.json at startup to opening the prebuilt symbol index, and times searches and lookups.
+    args are the path of the symbols file and the searches to run.
+    """
+    path = args[0] if args else 'symbols.json'
+    searches = args[1:] or ['A', 'APP', 'BANK', 'TESLA']
+    directory = tempfile.mkdtemp()
+    try:
+        def load_json():
+            with open(path, 'r') as symbol_file:
+                return json.load(symbol_file)
+        _, parse_time, parse_peak = measure(load_json)
+        start = time.perf_counter()
+        SymbolIndex(path, directory).load()
+        print(f'index built in {(time.perf_counter() - start) * 1000:,.2f}ms, '
+              f'{sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)):,} bytes')
+        _, open_time, open_peak = measure(lambda: SymbolIndex(path, directory).search(searches[0]))
+        report('startup, parse json -> open index and search', open_time, parse_time, open_peak, parse_peak)
+        index = SymbolIndex(path, directory)
+        for text in searches:
+            results, search_time, _ = measure(index.search, text, repeat=100)
+            print(f'search {text!r}: {search_time * 1000:,.3f}ms, {", ".join(results[:5])}')
+        symbols = load_json()
+        assert all(index.lookup(tag) == details for tag, details in symbols.items()), 'symbol table differs from json'
+        tag = sorted(symbols)[len(symbols) // 2]
+        _, dict_time, _ = measure(lambda: symbols[tag]['NAME'], repeat=1000)
+        _, table_time, _ = measure(index.get_name, tag, repeat=1000)
+        print(f'name lookup: {dict_time * 1e6:,.2f}us from the json dictionary, {table_time * 1e6:,.2f}us from the table')
+    finally:
+        shutil.rmtree(directory)
+
+BENCHMARKS = {'pages': bench_page_parse, 'portfolio_io': bench_portfolio_io, 'analytics': bench_analytics,
+              'backtest': bench_backtest, 'backfill': bench_backfill, 'symbols': bench_symbols}
+
+if __name__ == '__main__':
+    # usage: python benchmark.py <benchmark> [args...]
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print('usage: python benchmark.py', '|'.join(BENCHMARKS), '[args...]')
+    else:
+        BENCHMARKS[sys.argv[1]](sys.argv[2:])
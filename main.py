@@ -1,3 +1,29 @@
+from os import environ
+import time
+
+# set TRYINVEST_STARTUP_REPORT to print how long each stage of starting the app took, and TRYINVEST_EAGER_SCREENS
+# to build every screen up front like older versions did, to compare against building them when first shown
+STARTUP_REPORT = bool(environ.get('TRYINVEST_STARTUP_REPORT'))
+EAGER_SCREENS = bool(environ.get('TRYINVEST_EAGER_SCREENS'))
+startup_times = [('start', time.perf_counter())]
+
+def mark_startup(stage):
+    """
+    Records that a stage of starting the app has finished
+    """
+    startup_times.append((stage, time.perf_counter()))
+
+def report_startup():
+    """
+    Prints how long each stage of starting the app took if the startup report is turned on
+    """
+    if not STARTUP_REPORT:
+        return
+    for (_, started), (stage, finished) in zip(startup_times, startup_times[1:]):
+        print(f'startup {stage}: {(finished - started) * 1000:,.1f}ms')
+    print(f'startup total: {(startup_times[-1][1] - startup_times[0][1]) * 1000:,.1f}ms'
+          f'{" (eager screens)" if EAGER_SCREENS else ""}')
+
 import kivy
 from kivy.app import App
 from kivy.uix.widget import Widget
@@ -14,30 +40,33 @@ from kivy.lang import Builder
 from kivy.core.window import Window
 from kivy.uix.screenmanager import ScreenManager, Screen, NoTransition, SlideTransition, CardTransition
 from kivy.clock import Clock
-from kivy_garden.graph import Graph, MeshLinePlot, LinePlot
 from kivy.uix.textinput import TextInput
 from kivy.uix.dropdown import DropDown
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
 
 import json
-from os.path import join
+from os import remove
+from os.path import exists, join
 
 import stock_scrape
 import layout_maker as lm
+from persistence import atomic_json_dump, WriteBehindWriter
+from market_store import SQLiteMarketDataStore
+from quote_engine import engine as quote_engine
 from layout_maker import CustomButton, CustomLayout, CustomLayoutItem
 from stocks import Portfolio, Position, Share
-from pygtrie import CharTrie
 
 # Set the app size
 Window.size = (414, 896)
 lm.SCREEN_SIZE = Window.size
+mark_startup('imports')
 
 user_data = None
-stock_data = None
-symbol_data = None
-tag_trie = None
+symbol_index = None
 save_portfolio = None
 
-MAX_PORTFOLIOS = 5
+MAX_PORTFOLIOS = 10
 
 # state
 prev_screens = []
@@ -141,54 +170,79 @@ class HomeScreen(Screen):
                                         rel_size=(1, .05), color= DARK_GREEN))
         self.rendered_layout = self.layout.create(size_hint=(1,.3), pos_hint={"top": 1})
         self.add_widget(self.rendered_layout)
-        self.share_section = None
 
-    def display_portfolio(self):
-        # Create a button for each position:
-        share_section = CustomLayout()
-        row = []
-        for position in current_portfolio.positions:
-            if row and len(row) % 3 == 0:
-                share_section.add_widget_row((.33, .25), *row, alignment='left')
-                row = []  
-            # get position info          
-            position.update_price()
-            tag = position.tag
-            num_shares = position.num_shares
-            day_change = position.day_change
-            current_price = position.current_price
-
-            #get the right arrow image based on day change
-            icon = 'images/up_arrow.png' if day_change >= 0 else 'images/down_arrow.png'
-
-            # each position will have a CustomButton
-            col = self.create_share_button(icon, tag, f'${current_price:,.2f}', f'(${day_change:+,.2f})')
-            row.append(col)
-
-        if row and len(row) % 3 == 0:
-            share_section.add_widget_row((.33, .25), *row, alignment='left')
-            row = []  
-
-        col = self.create_share_button('images/plus.png', 'Buy', 'Stocks', '')     
-        row.append(col)
-        share_section.add_widget_row((.33, .25), *row, alignment='left')
-
-        # add the share section to the page
-        if self.share_section:
-            self.remove_widget(self.share_section)
-        self.share_section = share_section.create(size_hint=(1,.60), pos_hint={"top": .60})
+        # the share section is a grid of tiles kept by tag, only tiles for positions that were added or removed
+        # are created or removed, and only the labels of a tile whose quote changed are updated
+        self.share_tiles = {}
+        self.share_labels = {}
+        self.shown_quotes = {}
+        self.share_grid = GridLayout(cols=3, size_hint_y=None)
+        self.share_grid.bind(minimum_height=self.share_grid.setter('height'))
+        self.share_grid.add_widget(self.create_share_button('images/plus.png', 'Buy', 'Stocks', ''))
+        self.share_section = ScrollView(size_hint=(1,.60), pos_hint={"top": .60})
+        self.share_section.add_widget(self.share_grid)
         self.add_widget(self.share_section)
-        # update personal value label
-        current_portfolio.update_value()
+
+    def display_portfolio(self):
+        """
+        Bring the share tiles in line with the positions of the current portfolio and fetch their quotes
+        """
+        global portfolio_changed
+        portfolio = current_portfolio
+        tags = list(portfolio.position_index)
+        for tag in [tag for tag in self.share_tiles if tag not in portfolio]:
+            self.share_grid.remove_widget(self.share_tiles.pop(tag))
+            del self.share_labels[tag]
+            self.shown_quotes.pop(tag, None)
+        for tag in tags:
+            if tag not in self.share_tiles:
+                # placeholders are shown until the quote arrives, the buy tile stays last
+                self.share_grid.add_widget(self.create_share_button('images/up_arrow.png', tag, '$--.--', '($--.--)'),
+                                           index=1)
+            position = portfolio[tag]
+            if position.current_price is not None:
+                self.display_quote(portfolio, tag, position.current_price, position.day_change)
+        if list(reversed(self.share_grid.children))[:-1] != [self.share_tiles[tag] for tag in tags]:
+            # a different portfolio's positions are in another order, the existing tiles are moved, not rebuilt
+            for tag in tags:
+                self.share_grid.remove_widget(self.share_tiles[tag])
+                self.share_grid.add_widget(self.share_tiles[tag], index=1)
+        portfolio_changed = False
+
+        # fetch the quotes off the main thread, the labels are filled in as each one arrives
+        self.quote_request = quote_engine.get_quotes(tags,
+                                                     on_quote=lambda *quote: self.display_quote(portfolio, *quote))
+        self.display_totals()
+
+    def display_quote(self, portfolio, tag, current_price, day_change):
+        """
+        Update the tile for one position once its quote has arrived
+        """
+        if portfolio is not current_portfolio or tag not in self.share_labels:
+            return # the portfolio was switched while the quote was loading
+        # the portfolio adjusts its totals by this position's change, so each quote costs the same to show
+        current_portfolio.apply_price(tag, current_price, day_change)
+        self.display_totals()
+        if self.shown_quotes.get(tag) == (current_price, day_change):
+            return
+        self.shown_quotes[tag] = (current_price, day_change)
+        icon, price_label, change_label = self.share_labels[tag]
+        #get the right arrow image based on day change
+        icon.widget.source = 'images/up_arrow.png' if day_change >= 0 else 'images/down_arrow.png'
+        price_label.widget.text = f'${current_price:,.2f}'
+        change_label.widget.text = f'(${day_change:+,.2f})'
+
+    def display_totals(self):
+        """
+        Update the personal value and cash labels from the portfolio's running totals
+        """
         self.personal_value.widget.text = f'${current_portfolio.current_value:,.2f}'
         self.personal_value_change.widget.text = f'{"+" if current_portfolio.total_gain_loss >= 0 else "-"}${abs(current_portfolio.total_gain_loss):,.2f}' 
         if current_portfolio.total_gain_loss < 0:
             self.personal_value_change.widget.color = RED
         else:
             self.personal_value_change.widget.color = WHITE
-
         self.cash_value.widget.text = f'${current_portfolio.cash:,.2f}'
-        portfolio_changed = False
 
     def create_share_button(self, icon, symbol, *labels):
         col = []
@@ -198,8 +252,14 @@ class HomeScreen(Screen):
         for label in labels:
             col.append(lm.createLabel(text=label, font_size=font_size, rel_size=(.1, .02)))
             font_size *= .5
+        self.share_labels[symbol] = col[1:]
         out = CustomButton(*col, spacing=0, padding=0)
         out.bind_on_release(lambda: self.share_pressed(symbol))
+        # sized like a cell of the old rows of three
+        out.size_hint = (None, None)
+        out.size = (lm.SCREEN_SIZE[0] * .33, lm.SCREEN_SIZE[1] * .25)
+        if symbol != 'Buy':
+            self.share_tiles[symbol] = out
         return out
 
     def share_pressed(self, symbol):
@@ -250,7 +310,8 @@ class StockDetailScreen(Screen):
 
         self.layout.add_item(lm.createLabel(text = 'Past Week Performace', font_size= 28, rel_size= (1, .1)))
 
-        # graph
+        # graph, kivy_garden.graph is only imported once this screen is first shown
+        from kivy_garden.graph import Graph
         self.graph = Graph(x_ticks_major=1, tick_color = (0,0,0,.5), xlabel='Days',
               y_grid_label=True, x_grid_label=True, precision='%.2f', padding=5,
               x_grid=True, y_grid=True, xmin=-5, xmax=-1, ymin=0, ymax=100,
@@ -263,15 +324,32 @@ class StockDetailScreen(Screen):
         self.add_widget(self.layout.create())
 
     def on_pre_enter(self):
-        position = Position(current_stock_symbol)
-        position.update_price()
-        self.stock_name.widget.text = symbol_data[position.tag]['NAME']
-        self.current_price.widget.text = f'${position.current_price:,.2f}'
-        self.stock_symbol.widget.text = position.tag
-        self.center_image.widget.source = 'images/up_arrow.png' if position.day_change >= 0 else 'images/down_arrow.png'
-        share_count = current_portfolio[position.tag].num_shares if current_portfolio[position.tag] else 0
+        tag = current_stock_symbol
+        self.stock_name.widget.text = (symbol_index.get_name(tag) if symbol_index else None) or tag
+        self.current_price.widget.text = '$---.--'
+        self.stock_symbol.widget.text = tag
+        position = current_portfolio[tag]
+        share_count = position.num_shares if position else 0
         self.num_shares.widget.text = f'You own {share_count} share{"s" if share_count != 1 else ""}'
-        self.plot_data(position.get_prev_week_data())
+        # the price and graph are filled in once they load
+        quote_engine.get_quotes([tag], on_quote=self.display_quote)
+        quote_engine.run(Position(tag).get_prev_week_data, on_done=lambda data: self.display_prev_week(tag, data))
+
+    def display_quote(self, tag, current_price, day_change):
+        """
+        Show the price of the stock once its quote has arrived
+        """
+        if tag != current_stock_symbol:
+            return
+        self.current_price.widget.text = f'${current_price:,.2f}'
+        self.center_image.widget.source = 'images/up_arrow.png' if day_change >= 0 else 'images/down_arrow.png'
+
+    def display_prev_week(self, tag, data):
+        """
+        Plot the previous week once it has loaded
+        """
+        if tag == current_stock_symbol and data:
+            self.plot_data(data)
 
     def plot_data(self, data):
         """
@@ -281,6 +359,7 @@ class StockDetailScreen(Screen):
         self.graph.ymax = max(price for _,price in data) * 1.01
         self.graph.ymin = min(price for _,price in data) * .99
         self.graph.y_ticks_major = (self.graph.ymax - self.graph.ymin) / 4
+        from kivy_garden.graph import LinePlot
         self.graph.remove_plot(self.plot)
         self.plot = LinePlot(color=WHITE, line_width=3)
         self.plot.points = data
@@ -294,6 +373,24 @@ class StockDetailScreen(Screen):
         trade_mode = 'BUY'
         screen_transition(self.manager, 'detail', 'trade', SLIDE_LEFT)
 
+# seconds to wait after the last keystroke before searching
+SEARCH_DELAY = .15
+SEARCH_LIMIT = 50
+
+class SymbolSearchRow(Button):
+    """
+    One row of the symbol search dropdown. Only enough rows to fill the dropdown are created,
+    the RecycleView moves them and changes their text as the results are scrolled.
+    """
+    search = ObjectProperty(None)
+
+    def __init__(self, **kwargs):
+        super(SymbolSearchRow, self).__init__(bold=True, background_color=DARK_GREEN, **kwargs)
+
+    def on_press(self):
+        if self.search:
+            self.search.dropdown_selected(self)
+
 class SymbolSearch(TextInput):
     def __init__(self, trade_screen=None, **kwargs):
         super(SymbolSearch, self).__init__(**kwargs)
@@ -305,24 +402,29 @@ class SymbolSearch(TextInput):
         self.dropdown.background_color = (1,1,1,1)
         self.trade_screen = trade_screen
 
-    def update_dropdown_items(self):
+        # the results are shown by a fixed pool of rows instead of a new button per result
+        self.row_height = Window.size[1] * .04
+        self.results = RecycleView(size_hint=(1, None), height=0, viewclass=SymbolSearchRow)
+        results_layout = RecycleBoxLayout(orientation='vertical', default_size=(None, self.row_height),
+                                          default_size_hint=(1, None), size_hint_y=None)
+        results_layout.bind(minimum_height=results_layout.setter('height'))
+        self.results.add_widget(results_layout)
+        self.dropdown.add_widget(self.results)
+        self.search_query = None
+        self.search_trigger = Clock.create_trigger(self.update_dropdown_items, SEARCH_DELAY)
+
+    def update_dropdown_items(self, *args):
         """
-        Create the buttons for the dropdown menu
-        """        
-        try:
-            self.dropdown.clear_widgets()
-            if self.text != '':
-                self.dropdown_items = tag_trie.items(prefix=self.text)
-            else:
-                raise ValueError()
-        except:
-            self.dropdown_items = []
-        if len(self.dropdown_items) > 50:
-            self.dropdown_items = self.dropdown_items[:50]
-        for tag,_ in self.dropdown_items:
-            button = Button(text=tag, bold=True, size_hint_y=None, height=Window.size[1] * .04,
-                            background_color=DARK_GREEN, on_press=lambda btn: self.dropdown_selected(btn))
-            self.dropdown.add_widget(button)
+        Show the symbols matching the search text in the dropdown menu
+        """
+        query = self.text.strip()
+        if query == self.search_query:
+            return
+        self.search_query = query
+        self.dropdown_items = symbol_index.search(query, limit=SEARCH_LIMIT) if query and symbol_index else []
+        self.results.data = [{'text': tag, 'search': self} for tag in self.dropdown_items]
+        self.results.height = min(len(self.dropdown_items) * self.row_height, self.dropdown.max_height)
+        self.results.scroll_y = 1
 
     def on_focus(self, text_input, focused):
         """
@@ -344,9 +446,10 @@ class SymbolSearch(TextInput):
 
     def on_text(self, text_input, text):
         """
-        Update the dropdown list to reflect the new search text
+        Update the dropdown list to reflect the new search text once typing pauses
         """
-        self.update_dropdown_items()
+        self.search_trigger.cancel()
+        self.search_trigger()
         try:
             self.dropdown.open()
         except:
@@ -420,6 +523,7 @@ class TradeScreen(Screen):
 
         self.current_price_label = lm.createLabel(font_size= 50, rel_size= (1, .1))
         self.current_price = 0
+        self.pending_symbol = None
         self.layout.add_item(self.current_price_label)
 
         self.more_info_button = Button(text="More Info", bold=True, font_size=12, background_normal='',
@@ -468,6 +572,7 @@ class TradeScreen(Screen):
         Show no symbol on the trade screen
         """
         self.current_symbol = None
+        self.pending_symbol = None
         self.symbol_search.text = 'Search'
         self.current_price_label.widget.text = f'$0'
         self.current_price = 0
@@ -479,21 +584,35 @@ class TradeScreen(Screen):
 
     def display_symbol(self, symbol):
         """
-        Show a symbol on the trade screen
+        Show a symbol on the trade screen, the price is filled in once its quote arrives
+        """
+        self.current_symbol = None
+        self.symbol_search.text = symbol
+        self.current_price_label.widget.text = '$---.--'
+        self.current_price = 0
+        self.pending_symbol = symbol
+        quote_engine.get_quotes([symbol], on_quote=self.display_quote)
+
+    def display_quote(self, symbol, current_price, day_change):
         """
-        position = Position(symbol)
-        position.update_price()
-        if position.current_price <= 0:
+        Show the price of a symbol once its quote has arrived
+        """
+        if symbol != self.pending_symbol:
+            return # a different symbol was chosen while this one was loading
+        if current_price <= 0:
             self.display_no_symbol()
             return
         self.current_symbol = symbol
         self.update_cash_value()
         self.symbol_search.text = self.current_symbol
-        self.current_price_label.widget.text = f'${position.current_price:,.2f}'
-        self.current_price = position.current_price
+        self.current_price_label.widget.text = f'${current_price:,.2f}'
+        self.current_price = current_price
         self.more_info_button.disabled = False
-        self.share_count = current_portfolio[position.tag].num_shares if current_portfolio[position.tag] else 0
+        position = current_portfolio[symbol]
+        self.share_count = position.num_shares if position else 0
         self.num_shares_owned.widget.text = f'You own {self.share_count} share{"s" if self.share_count != 1 else ""}'
+        self.update_estimated_value()
+        self.check_confirm_button()
 
     def buy_sell_button(self, button):
         """
@@ -609,6 +728,7 @@ class MenuScreen(Screen):
         self.layout.add_item(lm.createLabel(text='Portfolios', font_size=30, color=DARK_GREEN, rel_size=(1, .08), alignment='left'))
 
         # Portfolio Buttons
+        self.portfolios = []
         self.portfolio_buttons = []
         for i in range(MAX_PORTFOLIOS):
             self.portfolio_buttons.append(Button(text="Empty", bold=False, font_size=28, background_normal='',
@@ -632,7 +752,7 @@ class MenuScreen(Screen):
     def on_pre_enter(self):
         portfolios = user_data['PORTFOLIOS']
         for i in range(MAX_PORTFOLIOS):
-            self.portfolio_buttons[i].text = portfolios[i]['NAME'] if i < len(portfolios) else 'Empty'
+            self.portfolio_buttons[i].text = self.portfolio_text(portfolios[i]) if i < len(portfolios) else 'Empty'
             self.portfolio_buttons[i].disabled = i >= len(portfolios)
             if i == current_portfolio_index:
                 self.portfolio_buttons[i].background_color = DARK_GREEN
@@ -640,6 +760,31 @@ class MenuScreen(Screen):
                 self.portfolio_buttons[i].background_color = TRANSPARENT
         self.add_portfolio_button.disabled = len(portfolios) >= MAX_PORTFOLIOS
 
+        # revalue every portfolio from one snapshot, each symbol is fetched once however many portfolios hold it
+        import valuation
+        self.portfolios = [Portfolio.load_portfolio(data) for data in portfolios]
+        menu_portfolios = self.portfolios
+        quote_engine.get_quotes(valuation.portfolio_tags(menu_portfolios),
+                                on_done=lambda quotes: self.display_values(menu_portfolios, quotes))
+
+    def portfolio_text(self, data):
+        """
+        Returns the text of a portfolio's button, its name and value
+        """
+        value = data.get('CURRENT_VALUE')
+        return data['NAME'] if value is None else f'{data["NAME"]}  ${value:,.2f}'
+
+    def display_values(self, portfolios, quotes):
+        """
+        Update the portfolio buttons with the values of the portfolios from the shared quote snapshot
+        """
+        if portfolios is not self.portfolios:
+            return # the menu was opened again while the quotes were loading
+        import valuation
+        valuation.value_portfolios(portfolios, quotes)
+        for button, portfolio in zip(self.portfolio_buttons, portfolios):
+            button.text = self.portfolio_text({'NAME': portfolio.name, 'CURRENT_VALUE': portfolio.current_value})
+
     def portfolio_selected(self, button):
         """
         Save the current portfolio then load the selected one then return to the home screen
@@ -740,39 +885,51 @@ class NewPortfolioScreen(Screen):
         save_portfolio()
 
 class WindowManager(ScreenManager):
-    pass
+    """
+    main.kv only creates the dummy and home screens, the rest are built the first time they are shown
+    """
+    lazy_screens = {'detail': StockDetailScreen, 'trade': TradeScreen, 'confirm_trade': ConfirmTradeScreen,
+                    'menu': MenuScreen, 'new_portfolio': NewPortfolioScreen, 'confirm_delete': ConfirmDeleteScreen}
+
+    def build_screen(self, name):
+        """
+        Creates the screen called name if it hasn't been created yet
+        """
+        if name in self.lazy_screens and not self.has_screen(name):
+            self.add_widget(self.lazy_screens[name]())
+
+    def on_current(self, instance, value):
+        self.build_screen(value)
+        super(WindowManager, self).on_current(instance, value)
 
 kv = Builder.load_file('main.kv')
+mark_startup('kv')
 class TryInvestApp(App):
     def build(self):
         Window.clearcolor = color_from_hex('#00d632')
+        if EAGER_SCREENS:
+            for name in kv.lazy_screens:
+                kv.build_screen(name)
         return kv
 
     def on_start(self):
         global user_data
-        global stock_data
-        global symbol_data
-        global tag_trie
         global save_portfolio
         user_data = self.load_storage_data('data.json')
         if user_data is None: # first time opening the app
             user_data = {'PORTFOLIOS': [Portfolio('My First Portfolio', 10000).get_save_dict()]}
-            stock_data = {}
-            symbol_json = open('symbols.json')
-            symbol_data = json.load(symbol_json)
-            symbol_json.close()
             self.save_storage_data(user_data, 'data.json')
-            self.save_storage_data(stock_data, 'stocks.json')
-            self.save_storage_data(symbol_data, 'symbols.json')
         else:
-            stock_data = self.load_storage_data('stocks.json')
-            symbol_data = self.load_storage_data('symbols.json')
-        
-        tag_trie = CharTrie()
-        for tag in symbol_data:
-            tag_trie[tag] = True
-        stock_scrape.stock_data_cache = stock_data
-        stock_scrape.stock_data_save_func = lambda data: self.save_storage_data(data, 'stocks.json')
+            # portfolios saved by older versions are converted to the current format
+            user_data['PORTFOLIOS'] = [Portfolio.migrate_save_dict(data) for data in user_data['PORTFOLIOS']]
+            # older versions kept a copy of symbols.json in storage, symbols are read from the index now
+            if exists(self.storage_file_path('symbols.json')):
+                remove(self.storage_file_path('symbols.json'))
+
+        stock_scrape.stock_data_store = SQLiteMarketDataStore(self.storage_file_path('stocks.db'),
+                                                              legacy_json_path=self.storage_file_path('stocks.json'),
+                                                              retention_days=stock_scrape.CACHE_RETENTION_DAYS)
+        stock_scrape.stock_data_writer = WriteBehindWriter(stock_scrape.stock_data_store.flush)
         load_portfolio(0)
         def _save_portfolio_func():
             global portfolio_changed
@@ -780,6 +937,54 @@ class TryInvestApp(App):
             user_data['PORTFOLIOS'][current_portfolio_index] = current_portfolio.get_save_dict()
             self.save_storage_data(user_data, 'data.json')
         save_portfolio = _save_portfolio_func
+        mark_startup('data')
+        Window.bind(on_flip=self.first_frame)
+
+    def first_frame(self, window):
+        """
+        Called once the first frame is on screen to finish the startup report
+        """
+        Window.unbind(on_flip=self.first_frame)
+        mark_startup('first frame')
+        report_startup()
+        # numpy and the modules built on it are only needed after the first frame, they are loaded off the main thread
+        quote_engine.run(self.open_symbol_index)
+        quote_engine.run(self.open_price_history)
+
+    def open_symbol_index(self):
+        """
+        Opens the symbol search index and table, only rebuilding it when symbols.json has changed
+        """
+        global symbol_index
+        from symbol_index import SymbolIndex
+        index = SymbolIndex('symbols.json', self.storage_file_path('symbol_index'))
+        index.load()
+        symbol_index = index
+
+    def open_price_history(self):
+        """
+        Opens the stored price history, until it is open closed days are scraped from the stock pages
+        """
+        from price_history import PriceHistory, MemmapHistoryBackend
+        stock_scrape.price_history_store = PriceHistory(MemmapHistoryBackend(self.storage_file_path('history')))
+
+    def on_pause(self):
+        self.flush_storage_data()
+        return True
+
+    def on_stop(self):
+        quote_engine.stop()
+        self.flush_storage_data()
+        stock_scrape.stock_data_store.close()
+        if stock_scrape.price_history_store:
+            stock_scrape.price_history_store.close()
+
+    def flush_storage_data(self):
+        """
+        Save anything still waiting to be written to the storage directory
+        """
+        if stock_scrape.stock_data_writer:
+            stock_scrape.stock_data_writer.flush()
 
     def storage_file_path(self, filename):
         """
@@ -804,9 +1009,8 @@ class TryInvestApp(App):
         """
         Saves a file in the App's storage directory
         """
-        with open(self.storage_file_path(filename), 'w') as save_file:
-            if file_type == 'JSON':
-                json.dump(data, save_file)
+        if file_type == 'JSON':
+            atomic_json_dump(data, self.storage_file_path(filename))
 
 
 if __name__ == '__main__':
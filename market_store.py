@@ -0,0 +1,228 @@
+import json
+import os
+import threading
+
+# how many old rows evict() removes at a time, so trimming a large backlog never stalls a flush
+EVICTION_BATCH_SIZE = 500
+
+class MarketDataStore():
+    """
+    Stores the closing price and day change of stocks by tag and date (a YYYY-MM-DD string).
+    Records are dictionaries in the form {"CLOSE_PRICE": 85.32, "DAY_CHANGE": -1.2}.
+    Writes may be buffered until flush() is called.
+    If retention_days is set only the records for the newest retention_days trading days are kept,
+    older ones are removed a batch at a time by evict().
+    """
+    def __init__(self, retention_days=None):
+        self.retention_days = retention_days
+        self.stats = {'HITS': 0, 'MISSES': 0, 'EVICTIONS': 0}
+
+    def get_stats(self):
+        """
+        Returns a dictionary with the number of lookup HITS and MISSES and the number of records evicted
+        """
+        return dict(self.stats)
+
+    def record_lookup(self, record):
+        """
+        Counts a lookup as a hit or miss and returns the record
+        """
+        self.stats['HITS' if record is not None else 'MISSES'] += 1
+        return record
+
+    def evict(self, batch_size=EVICTION_BATCH_SIZE):
+        """
+        Removes up to batch_size records that fall outside the retention policy and returns how many were removed
+        """
+        return 0
+
+    def get(self, tag, date):
+        """
+        Returns the record for tag on date, or None if it isn't stored
+        """
+        raise NotImplementedError()
+
+    def get_range(self, tag, start_date, end_date):
+        """
+        Returns a list of (date, record) tuples for tag between start_date and end_date (inclusive), oldest first
+        """
+        raise NotImplementedError()
+
+    def put(self, tag, date, record):
+        """
+        Stores the record for tag on date
+        """
+        self.put_many([(tag, date, record)])
+
+    def put_many(self, rows):
+        """
+        Stores many (tag, date, record) tuples at once
+        """
+        raise NotImplementedError()
+
+    def flush(self):
+        """
+        Writes any buffered records to permanent storage
+        """
+        pass
+
+    def close(self):
+        """
+        Flushes and releases any resources held by this store
+        """
+        self.flush()
+
+class DictMarketDataStore(MarketDataStore):
+    """
+    Keeps the records in memory as a nested dictionary in the form {date: {tag: record}}
+    """
+    def __init__(self, data=None, retention_days=None):
+        super(DictMarketDataStore, self).__init__(retention_days)
+        self.data = data if data is not None else {}
+        self.lock = threading.Lock()
+
+    def get(self, tag, date):
+        with self.lock:
+            return self.record_lookup(self.data.get(date, {}).get(tag))
+
+    def get_range(self, tag, start_date, end_date):
+        with self.lock:
+            return sorted((date, tags[tag]) for date, tags in self.data.items()
+                          if start_date <= date <= end_date and tag in tags)
+
+    def put_many(self, rows):
+        with self.lock:
+            for tag, date, record in rows:
+                self.data.setdefault(date, {})[tag] = record
+        self.evict()
+
+    def evict(self, batch_size=EVICTION_BATCH_SIZE):
+        removed = 0
+        with self.lock:
+            if self.retention_days is None:
+                return 0
+            # whole days are dropped, oldest first
+            for date in sorted(self.data)[:-self.retention_days]:
+                if removed >= batch_size:
+                    break
+                removed += len(self.data.pop(date))
+            self.stats['EVICTIONS'] += removed
+        return removed
+
+class SQLiteMarketDataStore(MarketDataStore):
+    """
+    Keeps the records in a local SQLite database indexed on (tag, date).
+    The database is only opened the first time it is used, and writes are buffered in memory until flush()
+    so a batch of cache misses costs one transaction.
+    If legacy_json_path points to a stocks.json file from an older version of the app it is imported the first
+    time the database is opened, then renamed so it is only imported once.
+    """
+    def __init__(self, path, legacy_json_path=None, retention_days=None):
+        super(SQLiteMarketDataStore, self).__init__(retention_days)
+        self.path = path
+        self.legacy_json_path = legacy_json_path
+        self.connection = None
+        self.pending = {} # (tag, date) -> record waiting to be written
+        self.lock = threading.RLock()
+
+    def connect(self):
+        """
+        Returns the database connection, opening the database and creating its table the first time
+        """
+        with self.lock:
+            if self.connection is None:
+                # sqlite3 is imported when the database is first used rather than at startup
+                import sqlite3
+                self.connection = sqlite3.connect(self.path, check_same_thread=False)
+                self.connection.execute('''CREATE TABLE IF NOT EXISTS daily_quotes (
+                                               tag TEXT NOT NULL,
+                                               date TEXT NOT NULL,
+                                               close_price REAL NOT NULL,
+                                               day_change REAL NOT NULL,
+                                               PRIMARY KEY (tag, date))''')
+                self.connection.execute('CREATE INDEX IF NOT EXISTS daily_quotes_date ON daily_quotes (date)')
+                self.connection.commit()
+                self.import_legacy_json()
+            return self.connection
+
+    def import_legacy_json(self):
+        """
+        Copies the records from an old stocks.json file into the database
+        """
+        if not self.legacy_json_path or not os.path.exists(self.legacy_json_path):
+            return
+        try:
+            with open(self.legacy_json_path, 'r') as legacy_file:
+                data = json.load(legacy_file)
+        except ValueError as e:
+            print('failed to import', self.legacy_json_path, e)
+            data = {}
+        self.write_rows((tag, date, record) for date, tags in data.items() for tag, record in tags.items()
+                        if record.get('CLOSE_PRICE'))
+        os.replace(self.legacy_json_path, self.legacy_json_path + '.imported')
+
+    def write_rows(self, rows):
+        """
+        Upserts (tag, date, record) tuples into the database in one transaction
+        """
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO daily_quotes VALUES (?, ?, ?, ?)',
+                                        ((tag, date, record['CLOSE_PRICE'], record['DAY_CHANGE'])
+                                         for tag, date, record in rows))
+
+    def get(self, tag, date):
+        with self.lock:
+            if (tag, date) in self.pending:
+                return self.record_lookup(self.pending[(tag, date)])
+            row = self.connect().execute('SELECT close_price, day_change FROM daily_quotes WHERE tag = ? AND date = ?',
+                                         (tag, date)).fetchone()
+            return self.record_lookup({'CLOSE_PRICE': row[0], 'DAY_CHANGE': row[1]} if row is not None else None)
+
+    def get_range(self, tag, start_date, end_date):
+        with self.lock:
+            rows = self.connect().execute('''SELECT date, close_price, day_change FROM daily_quotes
+                                             WHERE tag = ? AND date BETWEEN ? AND ? ORDER BY date''',
+                                          (tag, start_date, end_date)).fetchall()
+            out = {date: {'CLOSE_PRICE': close_price, 'DAY_CHANGE': day_change} for date, close_price, day_change in rows}
+            out.update({date: record for (pending_tag, date), record in self.pending.items()
+                        if pending_tag == tag and start_date <= date <= end_date})
+        return sorted(out.items())
+
+    def put_many(self, rows):
+        with self.lock:
+            for tag, date, record in rows:
+                self.pending[(tag, date)] = record
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            self.connect()
+            self.write_rows((tag, date, record) for (tag, date), record in self.pending.items())
+            self.pending = {}
+            self.evict()
+
+    def evict(self, batch_size=EVICTION_BATCH_SIZE):
+        with self.lock:
+            if self.retention_days is None:
+                return 0
+            connection = self.connect()
+            cutoff = connection.execute('SELECT DISTINCT date FROM daily_quotes ORDER BY date DESC LIMIT 1 OFFSET ?',
+                                        (self.retention_days - 1,)).fetchone()
+            if cutoff is None:
+                return 0
+            with connection:
+                removed = connection.execute('''DELETE FROM daily_quotes WHERE rowid IN
+                                                (SELECT rowid FROM daily_quotes WHERE date < ? LIMIT ?)''',
+                                             (cutoff[0], batch_size)).rowcount
+            self.stats['EVICTIONS'] += removed
+        return removed
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            if self.connection is not None:
+                self.evict()
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
@@ -0,0 +1,65 @@
+import json
+import os
+import tempfile
+import threading
+
+def atomic_json_dump(data, path):
+    """
+    Saves data as json to path by writing a temporary file next to it and renaming it over the old file,
+    so a crash part way through a save never leaves a truncated file behind.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as temp_file:
+            json.dump(data, temp_file)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+class WriteBehindWriter():
+    """
+    Batches saves: callers mark the data dirty whenever it changes and save_func is called once,
+    delay seconds after the first change, no matter how many changes were made in between.
+    flush() saves right away and should be called when the app is paused or stopped.
+    """
+    def __init__(self, save_func, delay=2.0):
+        self.save_func = save_func
+        self.delay = delay
+        self.dirty = False
+        self.timer = None
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+
+    def mark_dirty(self):
+        """
+        Records that the data has changed and schedules a save if one isn't already scheduled
+        """
+        with self.lock:
+            self.dirty = True
+            if self.timer is None:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        """
+        Saves the data now if it has changed since the last save
+        """
+        with self.save_lock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                if not self.dirty:
+                    return
+                self.dirty = False
+            try:
+                self.save_func()
+            except Exception as e:
+                print('failed to save', e)
+                with self.lock:
+                    self.dirty = True
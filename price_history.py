@@ -0,0 +1,335 @@
+import json
+import os
+import threading
+from datetime import date, timedelta
+import numpy as np
+
+import stock_scrape
+from persistence import atomic_json_dump
+
+# one daily bar, date is the day's proleptic Gregorian ordinal (date.toordinal())
+BAR_DTYPE = np.dtype([('date', '<i4'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'),
+                      ('close', '<f8'), ('volume', '<i8')])
+# longest range fetched with one request, the history page only lists about 100 rows
+FETCH_CHUNK_DAYS = 90
+# an empty fetch of more weekdays than this can't just be market holidays, so it is treated as a failed fetch
+MAX_MARKET_HOLIDAYS = 2
+
+def bars_from_rows(rows):
+    """
+    Converts stock_scrape.HistoryRow tuples to a sorted array of bars, missing values become nan (or 0 for volume)
+    """
+    bars = np.array([(row.date.date().toordinal(),
+                      *(value if value is not None else np.nan for value in (row.open, row.high, row.low, row.close)),
+                      row.volume or 0) for row in rows], dtype=BAR_DTYPE)
+    bars.sort(order='date')
+    return bars
+
+class HistoryBackend():
+    """
+    Stores daily bars by tag, along with the range of days that have been fetched for each tag (its coverage)
+    so days the market was closed are not fetched again.
+    """
+    def read_range(self, tag, start, end):
+        """
+        Returns a BAR_DTYPE array of the stored bars for tag with start <= date <= end (ordinals), oldest first
+        """
+        raise NotImplementedError()
+
+    def write_bars(self, tag, bars):
+        """
+        Stores a BAR_DTYPE array of bars for tag, replacing any stored bars on the same days
+        """
+        raise NotImplementedError()
+
+    def get_coverage(self, tag):
+        """
+        Returns (first, last) ordinals of the range of days fetched for tag, or None if nothing was fetched
+        """
+        raise NotImplementedError()
+
+    def set_coverage(self, tag, first, last):
+        """
+        Records that every trading day from first to last has been fetched for tag
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """
+        Releases any resources held by this backend
+        """
+        pass
+
+class SQLiteHistoryBackend(HistoryBackend):
+    """
+    Keeps the bars in a local SQLite database indexed on (tag, date), opened the first time it is used
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.lock = threading.RLock()
+
+    def connect(self):
+        """
+        Returns the database connection, opening the database and creating its tables the first time
+        """
+        with self.lock:
+            if self.connection is None:
+                import sqlite3
+                self.connection = sqlite3.connect(self.path, check_same_thread=False)
+                self.connection.execute('''CREATE TABLE IF NOT EXISTS daily_bars (
+                                               tag TEXT NOT NULL,
+                                               date INTEGER NOT NULL,
+                                               open REAL, high REAL, low REAL, close REAL NOT NULL, volume INTEGER,
+                                               PRIMARY KEY (tag, date))''')
+                self.connection.execute('''CREATE TABLE IF NOT EXISTS coverage (
+                                               tag TEXT PRIMARY KEY,
+                                               first_date INTEGER NOT NULL,
+                                               last_date INTEGER NOT NULL)''')
+                self.connection.commit()
+            return self.connection
+
+    def read_range(self, tag, start, end):
+        with self.lock:
+            rows = self.connect().execute('''SELECT date, open, high, low, close, volume FROM daily_bars
+                                             WHERE tag = ? AND date BETWEEN ? AND ? ORDER BY date''',
+                                          (tag, start, end)).fetchall()
+        return np.array([tuple(np.nan if value is None else value for value in row) for row in rows], dtype=BAR_DTYPE)
+
+    def write_bars(self, tag, bars):
+        with self.lock, self.connect():
+            self.connection.executemany('INSERT OR REPLACE INTO daily_bars VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                        ((tag, *bar) for bar in bars.tolist()))
+
+    def get_coverage(self, tag):
+        with self.lock:
+            row = self.connect().execute('SELECT first_date, last_date FROM coverage WHERE tag = ?', (tag,)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def set_coverage(self, tag, first, last):
+        with self.lock, self.connect():
+            self.connection.execute('INSERT OR REPLACE INTO coverage VALUES (?, ?, ?)', (tag, first, last))
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+class MemmapHistoryBackend(HistoryBackend):
+    """
+    Keeps the bars of each tag in its own file of fixed width BAR_DTYPE records sorted by date, which is memory
+    mapped for reading. Range reads binary search the date column and copy out only the bars in range, so nothing
+    is parsed. No views of a mapping are handed out, so the file can be replaced when bars are merged into it,
+    which Windows refuses while the file is still mapped. Coverage is kept in a small json file next to the bar files.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.maps = {} # tag -> np.memmap of its bar file
+        self.coverage = None
+        self.lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+
+    def bar_path(self, tag):
+        return os.path.join(self.directory, tag.replace('/', '_') + '.bars')
+
+    def get_map(self, tag):
+        """
+        Returns the read only memory map of the bars for tag, or an empty array if none are stored.
+        A partial record left at the end of the file by an interrupted append is cut off first.
+        Must be called while holding self.lock.
+        """
+        bars = self.maps.get(tag)
+        if bars is None:
+            path = self.bar_path(tag)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            if size % BAR_DTYPE.itemsize:
+                size -= size % BAR_DTYPE.itemsize
+                os.truncate(path, size)
+            if size == 0:
+                return np.empty(0, dtype=BAR_DTYPE)
+            bars = self.maps[tag] = np.memmap(path, dtype=BAR_DTYPE, mode='r')
+        return bars
+
+    def read_range(self, tag, start, end):
+        with self.lock:
+            bars = self.get_map(tag)
+            dates = bars['date']
+            return np.array(bars[np.searchsorted(dates, start, 'left'):np.searchsorted(dates, end, 'right')])
+
+    def write_bars(self, tag, bars):
+        if len(bars) == 0:
+            return
+        with self.lock:
+            stored = self.get_map(tag)
+            path = self.bar_path(tag)
+            if len(stored) == 0 or bars['date'][0] > stored['date'][-1]:
+                # new days after everything stored, the usual case, are appended in place
+                del stored
+                self.maps.pop(tag, None)
+                with open(path, 'ab') as bar_file:
+                    bars.tofile(bar_file)
+                return
+            # otherwise merge, the new bars replace stored bars on the same days
+            merged = np.concatenate([stored[~np.isin(stored['date'], bars['date'])], bars])
+            merged.sort(order='date')
+            # the file is unmapped once the last reference to the mapping is gone
+            del stored
+            self.maps.pop(tag, None)
+            temp_path = path + '.tmp'
+            merged.tofile(temp_path)
+            os.replace(temp_path, path)
+
+    def coverage_path(self):
+        return os.path.join(self.directory, 'coverage.json')
+
+    def load_coverage(self):
+        """
+        Returns the coverage of every tag, loading it from disk the first time
+        """
+        with self.lock:
+            if self.coverage is None:
+                try:
+                    with open(self.coverage_path(), 'r') as coverage_file:
+                        self.coverage = json.load(coverage_file)
+                except (OSError, ValueError):
+                    self.coverage = {}
+            return self.coverage
+
+    def get_coverage(self, tag):
+        coverage = self.load_coverage().get(tag)
+        return tuple(coverage) if coverage is not None else None
+
+    def set_coverage(self, tag, first, last):
+        with self.lock:
+            self.load_coverage()[tag] = [first, last]
+            atomic_json_dump(self.coverage, self.coverage_path())
+
+    def close(self):
+        with self.lock:
+            self.maps = {}
+
+class PriceHistory():
+    """
+    A persistent store of daily bars per tag. Days that are already stored are returned without any network
+    access and only the trading days missing from a tag's coverage are fetched.
+    Only closed days (up to yesterday) are stored since today's bar is still changing.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.tag_locks = {}
+
+    def tag_lock(self, tag):
+        """
+        Returns the lock that stops two threads from backfilling the same tag at once
+        """
+        with self.lock:
+            return self.tag_locks.setdefault(tag, threading.Lock())
+
+    def get_bars(self, tag, start, end, fetch=True):
+        """
+        Returns a BAR_DTYPE array of the bars for tag from start to end (dates), oldest first,
+        fetching only the days missing from the store. If fetch is False only the stored bars are returned.
+        """
+        last_closed = (stock_scrape.today() - timedelta(1)).date()
+        start_ordinal, end_ordinal = start.toordinal(), min(end, last_closed).toordinal()
+        if fetch and start_ordinal <= end_ordinal:
+            with self.tag_lock(tag):
+                self.backfill(tag, start_ordinal, end_ordinal)
+        return self.backend.read_range(tag, start.toordinal(), end.toordinal())
+
+    def get_latest_bars(self, tag, count):
+        """
+        Returns the bars for the last count trading days before today, oldest first
+        """
+        end = (stock_scrape.today() - timedelta(1)).date()
+        # enough calendar days to cover count trading days plus weekends and holidays
+        start = end - timedelta(count * 7 // 5 + 7)
+        return self.get_bars(tag, start, end)[-count:]
+
+    def listed_after(self, tag, first, last):
+        """
+        Returns True if the first stored bar of tag is too many trading days after first to be market holidays,
+        meaning the coverage of tag already reaches back before it was listed
+        """
+        bars = self.backend.read_range(tag, first, last)
+        return len(bars) > 0 and trading_days(first, int(bars['date'][0]) - 1) > MAX_MARKET_HOLIDAYS
+
+    def backfill(self, tag, start, end):
+        """
+        Fetches the days from start to end (ordinals) that are outside of the coverage for tag.
+        Coverage only grows over chunks that returned rows, so a blocked or changed page is fetched again next time.
+        Empty chunks before the first chunk with rows of a tag are from before it was listed and are covered too.
+        Raises ValueError if any other chunk too long to be only market holidays came back empty.
+        """
+        coverage = self.backend.get_coverage(tag)
+        first, last = coverage if coverage is not None else (None, None)
+        if coverage is None:
+            gaps = [(start, end)]
+        elif start < first and self.listed_after(tag, first, last):
+            # there is nothing to fetch before a tag was listed
+            first = start
+            gaps = [(last + 1, end)]
+        else:
+            gaps = [(start, first - 1), (last + 1, end)]
+        gaps = [(gap_start, gap_end) for gap_start, gap_end in gaps if has_trading_day(gap_start, gap_end)]
+        # fetched one after another since this usually already runs on stock_scrape's thread pool
+        rows = []
+        fetched = [] # (gap_start, gap_end, [(chunk_start, chunk_end, found rows)]) oldest first
+        for gap_start, gap_end in gaps:
+            chunks = []
+            for chunk_start in range(gap_start, gap_end + 1, FETCH_CHUNK_DAYS):
+                chunk_end = min(chunk_start + FETCH_CHUNK_DAYS - 1, gap_end)
+                chunk_rows = stock_scrape.get_history_scrape(tag, date.fromordinal(chunk_start), date.fromordinal(chunk_end))
+                rows.extend(chunk_rows)
+                chunks.append((chunk_start, chunk_end, bool(chunk_rows)))
+            fetched.append((gap_start, gap_end, chunks))
+        if rows:
+            self.backend.write_bars(tag, bars_from_rows(rows))
+
+        failed = []
+        for gap_start, gap_end, chunks in fetched:
+            if first is None or gap_end < first:
+                # nothing is stored before this gap, so the empty chunks before the first one with rows are from
+                # before the tag was listed. If none of them found rows the tag may not exist or the page failed.
+                listed = next((i for i, (_, _, found) in enumerate(chunks) if found), len(chunks))
+                if listed < len(chunks):
+                    chunks = [(chunk_start, chunk_end, True) for chunk_start, chunk_end, _ in chunks[:listed]] + \
+                             chunks[listed:]
+            failed.extend((chunk_start, chunk_end) for chunk_start, chunk_end, found in chunks
+                          if not found and trading_days(chunk_start, chunk_end) > MAX_MARKET_HOLIDAYS)
+            if first is not None and gap_end < first:
+                # grow the coverage back from its first day over the chunks that found rows
+                for chunk_start, _, found in reversed(chunks):
+                    if not found:
+                        break
+                    first = chunk_start
+            else:
+                # grow the coverage forward from its last day (or the start) over the chunks that found rows
+                for chunk_start, chunk_end, found in chunks:
+                    if not found:
+                        break
+                    if first is None:
+                        first = chunk_start
+                    last = chunk_end
+        if first is not None and (first, last) != coverage:
+            self.backend.set_coverage(tag, first, last)
+        if failed:
+            raise ValueError(f'no history found for {tag} between {date.fromordinal(failed[0][0])} '
+                             f'and {date.fromordinal(failed[0][1])}')
+
+    def close(self):
+        self.backend.close()
+
+def trading_days(start, end):
+    """
+    Returns the number of weekdays between the start and end ordinals (inclusive)
+    """
+    return sum(date.fromordinal(day).weekday() < 5 for day in range(start, end + 1))
+
+def has_trading_day(start, end):
+    """
+    Returns True if there is a weekday between the start and end ordinals (inclusive)
+    """
+    return any(date.fromordinal(day).weekday() < 5 for day in range(start, min(end, start + 6) + 1))
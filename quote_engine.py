@@ -0,0 +1,104 @@
+import asyncio
+import threading
+from kivy.clock import Clock
+
+import stock_scrape
+
+class QuoteEngine():
+    """
+    Runs an asyncio event loop on a background thread so quotes can be fetched without blocking the Kivy main thread.
+    The blocking scrape functions run on stock_scrape's thread pool, and results are handed back to widgets on the
+    Kivy thread through Clock.schedule_once.
+    """
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the event loop thread if it isn't running yet
+        """
+        with self.lock:
+            if self.loop is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, name='quote_engine', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        Stops the event loop thread, requests that are still running are abandoned
+        """
+        with self.lock:
+            if self.loop is None:
+                return
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+            self.thread = None
+
+    def submit(self, coroutine, on_done=None):
+        """
+        Schedules a coroutine on the engine's loop and returns a concurrent.futures.Future for its result.
+        If on_done is given it is called with the result on the Kivy thread once the coroutine finishes.
+        """
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        def _done(future):
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                print('quote engine request failed', future.exception())
+            elif on_done:
+                deliver(on_done, future.result())
+        future.add_done_callback(_done)
+        return future
+
+    def run(self, func, *args, on_done=None):
+        """
+        Runs the blocking function func(*args) off the Kivy thread and returns a future for its result.
+        """
+        return self.submit(self._run_blocking(func, *args), on_done)
+
+    def get_quotes(self, tags, on_quote=None, on_done=None):
+        """
+        Fetches the current price and day change of every tag and returns a future for the dictionary
+        {tag: (price, day_change)}. on_quote(tag, price, day_change) is called on the Kivy thread as each quote
+        arrives and on_done(quotes) once all of them have.
+        """
+        return self.submit(self._get_quotes(list(dict.fromkeys(tags)), on_quote), on_done)
+
+    async def _run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(stock_scrape.get_executor(), func, *args)
+
+    async def _get_quote(self, tag):
+        return tag, await self._run_blocking(stock_scrape.get_quote, tag)
+
+    async def _get_quotes(self, tags, on_quote):
+        quotes = {}
+        if tags and stock_scrape.market_open():
+            try:
+                quotes = await self._run_blocking(stock_scrape.get_latest_quotes_scrape, tags)
+            except Exception as e:
+                print('failed to get batch quotes for', tags, e)
+            for tag, quote in quotes.items():
+                if on_quote:
+                    deliver(on_quote, tag, *quote)
+        # anything the batch request missed is fetched one tag at a time, delivered in the order they finish
+        missing = [self._get_quote(tag) for tag in tags if tag not in quotes]
+        for next_quote in asyncio.as_completed(missing):
+            tag, quote = await next_quote
+            quotes[tag] = quote
+            if on_quote:
+                deliver(on_quote, tag, *quote)
+        return quotes
+
+def deliver(callback, *args):
+    """
+    Calls callback(*args) on the Kivy thread at the next frame
+    """
+    Clock.schedule_once(lambda dt: callback(*args))
+
+engine = QuoteEngine()
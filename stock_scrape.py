@@ -1,11 +1,83 @@
 import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
 from datetime import datetime, timedelta
 from pytz import timezone
-from bs4 import BeautifulSoup
-import requests
 
-stock_data_cache = {}
-stock_data_save_func = None
+# lxml and requests are only imported by the functions that use them, so importing this module at startup
+# doesn't pay for them before the first request
+from market_store import DictMarketDataStore
+
+# number of trading days of previous day closes to keep cached
+CACHE_RETENTION_DAYS = 30
+# where the previous day closes are cached, the app replaces this in memory store with a persistent one
+stock_data_store = DictMarketDataStore(retention_days=CACHE_RETENTION_DAYS)
+# a persistence.WriteBehindWriter that flushes stock_data_store, set by the app
+stock_data_writer = None
+# a price_history.PriceHistory that closed days are read from, set by the app. Pages are scraped directly if None
+price_history_store = None
+
+QUOTE_URL = 'https://query1.finance.yahoo.com/v7/finance/quote'
+QUOTE_BATCH_SIZE = 50
+# the quote endpoint answers 401 "Invalid Crumb" unless the request carries a crumb, which is handed out for the
+# cookie Yahoo sets on any visit to COOKIE_URL
+COOKIE_URL = 'https://fc.yahoo.com'
+CRUMB_URL = 'https://query1.finance.yahoo.com/v1/test/getcrumb'
+
+# seconds to wait for any single request before giving up on it
+REQUEST_TIMEOUT = 10
+# number of requests that may be in flight at once
+MAX_WORKERS = 8
+
+# connection pooling, a pool is kept for up to POOL_CONNECTIONS hosts with at most POOL_MAXSIZE
+# open connections to each one
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = MAX_WORKERS
+# responses that are worth trying again after backing off
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 3
+BACKOFF_BASE = .5
+BACKOFF_MAX = 8
+USER_AGENT = 'Mozilla/5.0'
+
+# fetched pages are kept for PAGE_CACHE_TTL seconds so the price and history extractors share one download.
+# The least recently used pages are dropped once the cached page sources add up to more than PAGE_CACHE_MAX_BYTES
+PAGE_CACHE_TTL = 60
+PAGE_CACHE_MAX_BYTES = 4 * 1024 * 1024
+
+# a tag whose scrape failed isn't scraped again for NEGATIVE_CACHE_TTL seconds. After BREAKER_THRESHOLD failures
+# in a row its circuit breaker opens and it is only retried by a background probe every BREAKER_COOLDOWN seconds
+NEGATIVE_CACHE_TTL = 5 * 60
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 30 * 60
+
+_executor = None
+_executor_lock = threading.Lock()
+_breakers = {} # tag -> CircuitBreaker for tags whose scrapes have been failing
+_breaker_lock = threading.Lock()
+_session = None
+_crumb = None
+_crumb_lock = threading.Lock()
+_session_lock = threading.Lock()
+_http_stats = {'REQUESTS': 0, 'RETRIES': 0, 'FAILURES': 0}
+# one row of the history table, date is a timezone aware datetime and the prices are floats (None if missing)
+HistoryRow = namedtuple('HistoryRow', ['date', 'open', 'high', 'low', 'close', 'volume'])
+# everything the app reads from a stock page: the quoted price (None if missing) and the history rows, newest first
+StockPage = namedtuple('StockPage', ['price', 'history'])
+
+HISTORY_COLUMNS = ['Date', 'Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume']
+PRICE_SPAN_ID = '50'
+# the quoted price is a lone span, found with a regular expression so it doesn't need the page parsed
+PRICE_SPAN_PATTERN = re.compile(r'<span[^>]*\sdata-reactid="' + PRICE_SPAN_ID + r'"[^>]*>([^<]*)<')
+
+_page_cache = OrderedDict() # (tag, period1, period2) -> (fetched_at, size, page)
+_page_cache_bytes = 0
+_page_fetches = {} # (tag, period1, period2) -> Future for pages currently being downloaded
+_page_cache_lock = threading.Lock()
 
 def today(_timezone='America/New_York'):
     """
@@ -13,43 +85,279 @@ def today(_timezone='America/New_York'):
     """
     return datetime.now(timezone(_timezone)).replace(hour=0, minute=0, second=0, microsecond=0)
 
-def load_stock_page(tag):
+def load_stock_page(tag, period1=None, period2=None):
+    """
+    Returns the parsed StockPage for the stock page showing the history between the period1 and period2
+    timestamps (the last week by default).
+    Pages are cached for PAGE_CACHE_TTL seconds, and callers asking for a page that is already being downloaded
+    wait for that download instead of starting another one.
+    """
+    if period2 is None:
+        period2 = int(today('GMT').timestamp())
+    if period1 is None:
+        period1 = int((today('GMT') - timedelta(7)).timestamp())
+    key = (tag, period1, period2)
+    with _page_cache_lock:
+        cached = _page_cache.get(key)
+        if cached is not None and time.monotonic() - cached[0] < PAGE_CACHE_TTL:
+            _page_cache.move_to_end(key)
+            return cached[2]
+        fetch = _page_fetches.get(key)
+        owner = fetch is None
+        if owner:
+            fetch = _page_fetches[key] = Future()
+    if not owner:
+        return fetch.result()
+
+    try:
+        compiled_url = f'https://finance.yahoo.com/quote/{tag}/history?period1={period1}&period2={period2}&interval=1d&filter=history&frequency=1d&includeAdjustedClose=true'
+        source = http_get(compiled_url).text
+        page = parse_stock_page(source)
+    except Exception as e:
+        with _page_cache_lock:
+            del _page_fetches[key]
+        fetch.set_exception(e)
+        raise
+    with _page_cache_lock:
+        del _page_fetches[key]
+        cache_page(key, page, page_size(page))
+    fetch.set_result(page)
+    return page
+
+def _parse_number(text, number_type=float):
+    """
+    Converts a number from the history table such as '1,234.50' or returns None if it isn't one
+    """
+    try:
+        return number_type(text.replace(',', ''))
+    except ValueError:
+        return None
+
+def parse_stock_page(source):
+    """
+    Extracts a StockPage from the html of a stock history page.
+    Only the markup of the history table is parsed into a tree, the rest of the page (mostly scripts and styles)
+    is only searched as text.
+    """
+    import lxml.html
+    price_match = PRICE_SPAN_PATTERN.search(source)
+    price = _parse_number(price_match.group(1)) if price_match is not None else None
+
+    table_start = source.find('<table')
+    table_end = source.find('</table>', table_start)
+    table = lxml.html.fragment_fromstring(source[table_start:table_end + len('</table>')]) \
+        if table_start != -1 and table_end != -1 else None
+
+    history = []
+    columns = {name: i for i, name in enumerate(HISTORY_COLUMNS)}
+    _timezone = timezone('GMT')
+    for row in table.iter('tr') if table is not None else []:
+        row_str = [elm.text_content() for elm in row.iter('span')]
+        if 'Date' in row_str:
+            # header row, read the column positions in case the layout changes
+            columns.update({name.rstrip('*'): i for i, name in enumerate(row_str)})
+            continue
+        try:
+            _date = _timezone.localize(datetime.strptime(row_str[columns['Date']], '%b %d, %Y'))
+            close = float(row_str[columns['Close']].replace(',', ''))
+        except (ValueError, IndexError):
+            continue # we found one of the end rows with no data, or a dividend/split row
+        values = [_parse_number(row_str[columns[name]]) if columns[name] < len(row_str) else None
+                  for name in ('Open', 'High', 'Low')]
+        volume = _parse_number(row_str[columns['Volume']], int) if columns['Volume'] < len(row_str) else None
+        history.append(HistoryRow(_date, *values, close, volume))
+    return StockPage(price, history)
+
+def page_size(page):
+    """
+    Rough number of bytes a StockPage takes up in memory, used to enforce PAGE_CACHE_MAX_BYTES
+    """
+    return 200 + 250 * len(page.history)
+
+def cache_page(key, page, size):
+    """
+    Stores a fetched page in the page cache, evicting the least recently used and expired pages to stay
+    under PAGE_CACHE_MAX_BYTES. Must be called while holding _page_cache_lock.
+    """
+    global _page_cache_bytes
+    if key in _page_cache:
+        _page_cache_bytes -= _page_cache.pop(key)[1]
+    if size > PAGE_CACHE_MAX_BYTES:
+        return
+    _page_cache[key] = (time.monotonic(), size, page)
+    _page_cache_bytes += size
+    now = time.monotonic()
+    for old_key in list(_page_cache):
+        fetched_at, old_size, _ = _page_cache[old_key]
+        if _page_cache_bytes <= PAGE_CACHE_MAX_BYTES and now - fetched_at < PAGE_CACHE_TTL:
+            break
+        del _page_cache[old_key]
+        _page_cache_bytes -= old_size
+
+def clear_page_cache():
+    """
+    Drops every cached page so the next lookups fetch fresh data
+    """
+    global _page_cache_bytes
+    with _page_cache_lock:
+        _page_cache.clear()
+        _page_cache_bytes = 0
+
+def get_session():
+    """
+    Returns the requests session shared by every fetch so connections to Yahoo are kept alive and reused,
+    creating it the first time.
+    """
+    global _session
+    import requests
+    from requests.adapters import HTTPAdapter
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, pool_block=True)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            _session.headers['User-Agent'] = USER_AGENT
+        return _session
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Returns how many seconds to wait before retry number attempt (starting at 0).
+    Uses exponential backoff with full jitter unless the server told us how long to wait.
+    """
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def http_get(url, params=None, timeout=None):
+    """
+    GETs url through the shared session, retrying connection errors, timeouts and 429/5xx responses
+    up to MAX_RETRIES times with jittered exponential backoff.
+    """
+    import requests
+    session = get_session()
+    timeout = REQUEST_TIMEOUT if timeout is None else timeout
+    for attempt in range(MAX_RETRIES + 1):
+        retry_after = None
+        with _session_lock:
+            _http_stats['REQUESTS'] += 1
+        try:
+            response = session.get(url, params=params, timeout=timeout)
+            if response.status_code not in RETRY_STATUSES:
+                return response
+            retry_after = response.headers.get('Retry-After')
+            if attempt == MAX_RETRIES:
+                response.raise_for_status()
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError):
+            if attempt == MAX_RETRIES:
+                with _session_lock:
+                    _http_stats['FAILURES'] += 1
+                raise
+        with _session_lock:
+            _http_stats['RETRIES'] += 1
+        time.sleep(backoff_delay(attempt, retry_after))
+
+def get_http_stats():
+    """
+    Returns a dictionary of counters for the shared session:
+    REQUESTS and RETRIES made, FAILURES that ran out of retries, NEW_CONNECTIONS opened and the
+    REUSE_RATE, the fraction of requests that were sent over an already open connection.
+    """
+    with _session_lock:
+        stats = dict(_http_stats)
+        session = _session
+    new_connections = 0
+    pooled_requests = 0
+    if session is not None:
+        pools = session.get_adapter('https://').poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                new_connections += pool.num_connections
+                pooled_requests += pool.num_requests
+    stats['NEW_CONNECTIONS'] = new_connections
+    stats['REUSE_RATE'] = 1 - new_connections / pooled_requests if pooled_requests else 0
+    return stats
+
+def get_executor():
+    """
+    Returns the thread pool shared by every concurrent fetch, creating it with MAX_WORKERS threads the first time.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='stock_scrape')
+        return _executor
+
+def set_max_workers(max_workers):
     """
-    Returns the Beautiful soup object for the stock page
+    Changes the size of the shared thread pool. Requests already running on the old pool are allowed to finish.
     """
-    period2 = int(today('GMT').timestamp())
-    period1 = int((today('GMT') - timedelta(7)).timestamp())
-    compiled_url = f'https://finance.yahoo.com/quote/{tag}/history?period1={period1}&period2={period2}&interval=1d&filter=history&frequency=1d&includeAdjustedClose=true'
-    source = requests.get(compiled_url).text
-    return  BeautifulSoup(source, 'lxml')
+    global _executor, MAX_WORKERS
+    with _executor_lock:
+        MAX_WORKERS = max_workers
+        old_executor, _executor = _executor, None
+    if old_executor is not None:
+        old_executor.shutdown(wait=False)
+
+def scrape_concurrently(func, tags, timeout=None):
+    """
+    Calls func(tag) for every tag on the shared thread pool and yields (tag, result) tuples in the order they finish.
+    If func raises, the exception is yielded as the result so one bad tag does not stop the rest.
+    timeout limits how long to wait for all of the results, any tag still running after it is yielded with a
+    TimeoutError.
+    """
+    executor = get_executor()
+    futures = {executor.submit(func, tag): tag for tag in dict.fromkeys(tags)}
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                yield futures[future], e
+    except FutureTimeoutError as e:
+        for future, tag in futures.items():
+            if not future.done():
+                future.cancel()
+                yield tag, e
 
 def get_latest_week_scrape(tag):
     """
     Returns a dictionary mapping the previous 5 dates to the closing price on those dates for this stock
     """
-    soup = load_stock_page(tag)
-    out = []
-    close_price_index = 4
+    return [(row.date, row.close) for row in load_stock_page(tag).history[:5]]
+
+def get_history_scrape(tag, start, end):
+    """
+    Returns the HistoryRow tuples for tag from the start date to the end date (inclusive), newest first
+    """
     _timezone = timezone('GMT')
-    for row in soup.find('table').find_all('tr'):
-        row_str = [elm.text for elm in row.find_all('span')]
-        if 'Close' in row_str:
-            close_price_index = row_str.index('Close')
-        try:
-            _date = _timezone.localize(datetime.strptime(row_str[0], '%b %d, %Y'))
-            out.append((_date, float(row_str[close_price_index].replace(',', ''))))
-            if len(out) == 5:
-                break
-        except Exception as e:
-            continue # we found one of the end rows with no data
-    return out
+    period1 = int(_timezone.localize(datetime.combine(start, datetime.min.time())).timestamp())
+    period2 = int(_timezone.localize(datetime.combine(end + timedelta(1), datetime.min.time())).timestamp())
+    return [row for row in load_stock_page(tag, period1, period2).history if start <= row.date.date() <= end]
+
+def get_latest_week_closes(tag):
+    """
+    Returns the (date, close price) tuples for the last 5 closed trading days, newest first,
+    from price_history_store if there is one.
+    """
+    if price_history_store is None:
+        return get_latest_week_scrape(tag)
+    _timezone = timezone('GMT')
+    bars = price_history_store.get_latest_bars(tag, 5)
+    return [(_timezone.localize(datetime.fromordinal(int(bar['date']))), float(bar['close'])) for bar in bars[::-1]]
 
 def get_latest_price_scrape(tag):
     """
     Scrapes the latest stock price for tag from finance.yahoo.com
     """
-    soup = load_stock_page(tag)
-    return soup.find('span', attrs={"data-reactid": "50"}).text
+    price = load_stock_page(tag).price
+    if price is None:
+        raise ValueError(f'no price found on the page for {tag}')
+    return price
 
 def get_date_str(date):
     """
@@ -61,17 +369,77 @@ def market_open():
     """
     Checks if the time is between 9:30am  and 4pm EST on a weekday.
     """
-    time = today() 
-    time = time.hour + time.minute/60
-    return today().weekday() < 5 and time >= 9.5 and time  < 16
+    now = datetime.now(timezone('America/New_York'))
+    time = now.hour + now.minute/60
+    return now.weekday() < 5 and time >= 9.5 and time < 16
+
+class CircuitBreaker():
+    """
+    Tracks the failed scrapes of one tag
+    """
+    def __init__(self):
+        self.failures = 0
+        self.retry_at = 0
+        self.probing = False
+
+    @property
+    def open(self):
+        return self.failures >= BREAKER_THRESHOLD
+
+def scrape_allowed(tag):
+    """
+    Returns False if tag failed recently and should not be scraped yet.
+    When an open breaker's cooldown has passed a probe is started in the background instead, so the caller
+    still returns straight away.
+    """
+    with _breaker_lock:
+        breaker = _breakers.get(tag)
+        if breaker is None:
+            return True
+        if time.monotonic() < breaker.retry_at or breaker.probing:
+            return False
+        if not breaker.open:
+            return True
+        breaker.probing = True
+    get_executor().submit(probe_tag, tag)
+    return False
+
+def record_scrape_failure(tag):
+    """
+    Negatively caches tag after a failed scrape, opening its breaker after BREAKER_THRESHOLD failures in a row
+    """
+    with _breaker_lock:
+        breaker = _breakers.setdefault(tag, CircuitBreaker())
+        breaker.failures += 1
+        breaker.probing = False
+        breaker.retry_at = time.monotonic() + (BREAKER_COOLDOWN if breaker.open else NEGATIVE_CACHE_TTL)
+
+def record_scrape_success(tag):
+    """
+    Closes the breaker for tag after a successful scrape
+    """
+    if tag in _breakers:
+        with _breaker_lock:
+            _breakers.pop(tag, None)
+
+def probe_tag(tag):
+    """
+    Checks in the background whether a tag with an open breaker can be scraped again
+    """
+    try:
+        if len(get_latest_week_closes(tag)) < 2:
+            raise ValueError(f'no history found for {tag}')
+    except Exception as e:
+        record_scrape_failure(tag)
+    else:
+        record_scrape_success(tag)
 
 def check_stock_cache(tag, date):
     """
     Returns the price of a stock at the end of a given date if that information is stored in the
     cache, else returns none.
     """
-    if date in stock_data_cache and tag in stock_data_cache[date]:
-        return stock_data_cache[date][tag]
+    return stock_data_store.get(tag, date)
 
 def get_prev_day_close(tag, get_day_change=False):
     """
@@ -85,20 +453,25 @@ def get_prev_day_close(tag, get_day_change=False):
     if cached is not None:
         close_price = cached['CLOSE_PRICE']
         day_change = cached['DAY_CHANGE']
+    elif not scrape_allowed(tag):
+        close_price = 0
+        day_change = 0
     else:
         try:
-            latest_week_scrape = get_latest_week_scrape(tag)
+            latest_week_scrape = get_latest_week_closes(tag)
             close_price = latest_week_scrape[0][1] 
             prev_close_price = latest_week_scrape[1][1]
             day_change = close_price - prev_close_price
         except Exception as e:
             print('failed to get previous day close for', tag, e)
+            record_scrape_failure(tag)
             close_price = 0
             day_change = 0
-        stock_data_cache.setdefault(yesterday_str, {})
-        stock_data_cache[yesterday_str][tag] = {'CLOSE_PRICE': close_price, 'DAY_CHANGE': day_change}
-        if close_price and stock_data_save_func:
-            stock_data_save_func(stock_data_cache)
+        else:
+            record_scrape_success(tag)
+            stock_data_store.put(tag, yesterday_str, {'CLOSE_PRICE': close_price, 'DAY_CHANGE': day_change})
+            if stock_data_writer:
+                stock_data_writer.mark_dirty()
     return (close_price, day_change) if get_day_change else close_price
 
 def get_current_price(tag, get_day_change=False):
@@ -107,23 +480,92 @@ def get_current_price(tag, get_day_change=False):
     If get_day_change is set to True, returns a tuple containing the current price and the day change
     """
     if market_open():
+        if not scrape_allowed(tag):
+            return 0
         try:
             current_price = float(get_latest_price_scrape(tag))
-            prev_price = get_prev_day_close(tag, get_day_change=False)
-            return (current_price, current_price - prev_price) if get_day_change else current_price 
         except Exception as e:
             print('failed to get current price for', tag, e)
+            record_scrape_failure(tag)
             return 0
+        record_scrape_success(tag)
+        prev_price = get_prev_day_close(tag, get_day_change=False)
+        return (current_price, current_price - prev_price) if get_day_change else current_price 
     else:
         return get_prev_day_close(tag, get_day_change=get_day_change)
 
+def get_crumb(refresh=False):
+    """
+    Returns the crumb the quote endpoint expects with the session's cookie, fetching both the first time
+    or again if refresh is True
+    """
+    global _crumb
+    with _crumb_lock:
+        if _crumb is None or refresh:
+            # only sets the cookie, the page itself is a 404
+            http_get(COOKIE_URL)
+            response = http_get(CRUMB_URL)
+            response.raise_for_status()
+            _crumb = response.text.strip()
+        return _crumb
+
+def get_latest_quotes_scrape(tags):
+    """
+    Fetches the quotes for all of the tags from finance.yahoo.com using one request per QUOTE_BATCH_SIZE tags.
+    Returns a dictionary mapping each tag found to a tuple containing its current price and day change.
+    The endpoint answers {"quoteResponse": {"result": [{"symbol": ..., "regularMarketPrice": ...,
+    "regularMarketChange": ...}, ...], "error": null}}, leaving out symbols it doesn't know.
+    """
+    out = {}
+    for i in range(0, len(tags), QUOTE_BATCH_SIZE):
+        batch = tags[i:i + QUOTE_BATCH_SIZE]
+        params = {'symbols': ','.join(batch), 'crumb': get_crumb()}
+        response = http_get(QUOTE_URL, params=params)
+        if response.status_code == 401:
+            # the crumb expired with its cookie
+            params['crumb'] = get_crumb(refresh=True)
+            response = http_get(QUOTE_URL, params=params)
+        response.raise_for_status()
+        for quote in response.json()['quoteResponse']['result']:
+            price = quote.get('regularMarketPrice')
+            if price is None:
+                continue
+            out[quote['symbol']] = (float(price), float(quote.get('regularMarketChange', 0)))
+    return out
+
+def get_current_prices(tags):
+    """
+    Returns a dictionary mapping each tag to a tuple containing its current price and day change.
+    While the market is open all of the tags are fetched together in as few requests as possible, otherwise
+    the previous day close is used, so only tags missing from the cache need to be fetched.
+    """
+    tags = list(dict.fromkeys(tags))
+    out = {}
+    if market_open():
+        try:
+            out = get_latest_quotes_scrape(tags)
+        except Exception as e:
+            print('failed to get batch quotes for', tags, e)
+    # anything the batch request missed falls back to the single tag path, fetched in parallel
+    missing = [tag for tag in tags if tag not in out]
+    for tag, quote in scrape_concurrently(get_quote, missing):
+        out[tag] = quote if isinstance(quote, tuple) else (0, 0)
+    return out
+
+def get_quote(tag):
+    """
+    Returns a tuple containing the current price and day change of tag, both are 0 if the price couldn't be found
+    """
+    quote = get_current_price(tag, get_day_change=True)
+    return quote if isinstance(quote, tuple) else (quote, 0)
+
 def get_prev_week_endpoints(tag):
     """
     Returns a list of tuples representing the past 5 closing prices for a stock
     The format for the list is:
     [(-5, 80.54), (-4, 81.2), ... (-1, 85.32)]
     """
-    last_week_scrape = get_latest_week_scrape(tag)
+    last_week_scrape = get_latest_week_closes(tag)
     _today = today('GMT')
     return [((_date - _today).days, close_price) for _date, close_price in last_week_scrape]
 
@@ -1,80 +1,142 @@
+from collections import deque
+
 import stock_scrape
 
+# version of the dictionaries returned by get_save_dict.
+# 1: one {"COST_BASIS", "BUY_DATE"} dictionary per share
+# 2: the lots of each position stored as columns
+SAVE_VERSION = 2
+
 class Portfolio():
     @staticmethod
     def load_portfolio(data):
         """
-        Creates a portfolio object from a python dictionary in the form returned by get_save_dict
+        Creates a portfolio object from a python dictionary in the form returned by get_save_dict,
+        older versions of the dictionary are migrated as they are loaded.
         """
-        portfolio = Portfolio(data['NAME'], data['CASH'], data['INITIAL_VALUE'], data.get('CURRENT_VALUE', None))
+        portfolio = Portfolio(data['NAME'], data['CASH'], data['INITIAL_VALUE'])
         for position_dict in data['POSITIONS']:
             portfolio.add_position(Position.load_position(position_dict))
         return portfolio
 
-    def __init__(self, name, cash, initial_value=None, current_value=None):
+    def __init__(self, name, cash, initial_value=None):
         self.name = name
-        self.positions = []
+        self.position_index = {} # tag -> position, in the order the positions were added
         self.cash = cash
         if initial_value is None:
             self.initial_value = cash
         else:
             self.initial_value = initial_value
 
-        if current_value is None:
-            self.update_value()
-        else:
-            self.current_value = current_value
-
-        self.update_value()
-        
+        # running totals over every position, adjusted by trades and price updates instead of recomputed
+        self.total_cost_basis = 0
+        self.market_value = 0
+        self.day_change = 0
+        self.update_totals()
 
     def __getitem__(self, tag):
-        for position in self.positions:
-            if position.tag == tag:
-                return position
-        return None
+        return self.position_index.get(tag)
+
+    def __contains__(self, tag):
+        return tag in self.position_index
+
+    @property
+    def positions(self):
+        """
+        The positions in this portfolio as a list, in the order they were added
+        """
+        return list(self.position_index.values())
 
     def add_position(self, *new_positions):
         """
         Adds a position to this portfolio, combining positions that already exists to prevent duplicates.
         """
         for new_position in new_positions:
-            found = False
-            for position in self.positions:
-                found = position.add_position(new_position)
-                if found:
-                    break
-
-            if not found:
-                self.positions.append(new_position)
+            position = self.position_index.get(new_position.tag)
+            if position is None:
+                self.position_index[new_position.tag] = new_position
+                self.add_to_totals(new_position)
+            else:
+                self.add_to_totals(position, -1)
+                position.add_position(new_position)
+                if new_position.current_price is not None:
+                    # the position being added has the newer price
+                    position.set_price(new_position.current_price, new_position.day_change)
+                self.add_to_totals(position)
+        self.update_totals()
 
-    def buy_shares(self, tag, quantity):
+    def buy_shares(self, tag, quantity, price=None, date=None):
         """
-        Purchase a certain amount of shares, subtracting the value of the new position from cash
+        Purchase a certain amount of shares, subtracting the value of the new position from cash.
+        The current price and today's date are used unless a price and date are given.
         """
         position = Position(tag)
-        position.add_share(num_shares=quantity)
+        if price is not None:
+            position.set_price(price, 0)
+        position.add_share(price, date, num_shares=quantity)
         self.cash -= quantity * position.current_price
         self.add_position(position)
 
-    def sell_shares(self, tag, quantity):
+    def sell_shares(self, tag, quantity, price=None):
         """
-        Sell a certain amount of shares, adding the value of the new position to cash
+        Sell a certain amount of shares, adding the value of the new position to cash.
+        The current price is used unless a price is given.
         """
-        position = [pos for pos in self.positions if pos.tag == tag][0]
-        position.update_price()
-        shares = [position.remove_share() for _ in range(quantity)]
+        position = self[tag]
+        owned = position.num_shares if position is not None else 0
+        if quantity > owned:
+            raise ValueError(f'cannot sell {quantity} shares of {tag}, only {owned} are owned')
+        # everything that can fail happens before the position is taken out of the running totals
+        if price is None:
+            price, day_change = stock_scrape.get_current_prices([tag])[tag]
+        else:
+            day_change = position.day_change
+        self.add_to_totals(position, -1)
+        position.set_price(price, day_change)
+        position.remove_shares(quantity)
         self.cash += position.current_price * quantity
         if position.num_shares == 0:
-            self.positions.remove(position)
+            del self.position_index[tag]
+        else:
+            self.add_to_totals(position)
+        self.update_totals()
+
+    def apply_price(self, tag, current_price, day_change):
+        """
+        Updates the price of one position and adjusts the portfolio totals by the difference
+        """
+        position = self[tag]
+        if position is None:
+            return
+        self.add_to_totals(position, -1)
+        position.set_price(current_price, day_change)
+        self.add_to_totals(position)
+        self.update_totals()
 
-    def update_value(self):
+    def add_to_totals(self, position, sign=1):
+        """
+        Adds the cost basis, value and day change of a position to the running totals, or subtracts them if sign is -1
         """
-        Updates the total value of this portfolio by checking current prices
+        self.total_cost_basis += sign * position.total_cost_basis
+        self.market_value += sign * position.num_shares * (position.current_price or 0)
+        self.day_change += sign * position.num_shares * (position.day_change or 0)
+
+    def update_totals(self):
         """
-        self.current_value = sum(position.get_value() for position in self.positions) + self.cash
+        Updates the current value and total gain/loss from the running totals
+        """
+        self.current_value = self.market_value + self.cash
         self.total_gain_loss = self.current_value - self.initial_value
 
+    def update_value(self, quotes=None):
+        """
+        Updates the total value of this portfolio and its positions by checking current prices, or using the quotes
+        given, see valuation.value_portfolio
+        """
+        # imported here so loading portfolios at startup doesn't import numpy
+        import valuation
+        return valuation.value_portfolio(self, quotes)
+
     def get_save_dict(self):
         """
         Returns a python dictionary representing this portfolio.
@@ -83,58 +145,88 @@ class Portfolio():
         bought on February 28, 2021 for $85 would return:
         {"NAME": "Portfolio 1", 
         "POSITIONS": [
-            {"TAG": "DIS", "NUM_SHARES": 3, "TOTAL_COST_BASIS": 570, "SHARES": [{"COST_BASIS": 190, "BUY_DATE": "2021/03/05"},
-                                                                      {"COST_BASIS": 190, "BUY_DATE": "2021/03/05"},
-                                                                      {"COST_BASIS": 190, "BUY_DATE": "2021/03/05"}]},
-            {"TAG": "AAPL", "NUM_SHARES": 1, "TOTAL_COST_BASIS": 85, "SHARES": [{"COST_BASIS": 85, "BUY_DATE": "2021/02/28"}]}
+            {"TAG": "DIS", "NUM_SHARES": 3, "TOTAL_COST_BASIS": 570, "LOTS": {"QUANTITY": [3], "COST_BASIS": [190], "BUY_DATE": ["2021/03/05"]}},
+            {"TAG": "AAPL", "NUM_SHARES": 1, "TOTAL_COST_BASIS": 85, "LOTS": {"QUANTITY": [1], "COST_BASIS": [85], "BUY_DATE": ["2021/02/28"]}}
             ],
         "CASH": 500,
         "CURRENT_VALUE": 1155
-        "INITIAL_VALUE": 1000
+        "INITIAL_VALUE": 1000,
+        "VERSION": 2
         }
         """
         return {"NAME": self.name, 
-                "POSITIONS": [position.get_save_dict() for position in self.positions],
+                "POSITIONS": [position.get_save_dict() for position in self.position_index.values()],
                 "CASH": self.cash,
                 "CURRENT_VALUE": self.current_value,
                 "INITIAL_VALUE": self.initial_value,
-                "CURRENT_VALUE": self.current_value}
+                "VERSION": SAVE_VERSION}
+
+    @staticmethod
+    def migrate_save_dict(data):
+        """
+        Converts a dictionary saved by an older version of get_save_dict to the current version
+        without loading any prices.
+        """
+        if data.get('VERSION', 1) == SAVE_VERSION:
+            return data
+        data = dict(data)
+        data['POSITIONS'] = [Position.load_position(position_dict).get_save_dict() for position_dict in data['POSITIONS']]
+        data['VERSION'] = SAVE_VERSION
+        return data
 
 class Position():
     @staticmethod
     def load_position(data):
         """
-        Creates a position object from a python dictionary in the form returned by get_save_dict
+        Creates a position object from a python dictionary in the form returned by get_save_dict,
+        or the per share form saved by version 1.
         """
         position = Position(data['TAG'])
-        for share_dict in data['SHARES']:
-            position.add_share(share_dict['COST_BASIS'], share_dict['BUY_DATE'])
+        if 'LOTS' in data:
+            lots = data['LOTS']
+            position.lots.extend(map(Lot, lots['QUANTITY'], lots['COST_BASIS'], lots['BUY_DATE']))
+            position.num_shares = sum(lots['QUANTITY'])
+            position.total_cost_basis = sum(map(lambda quantity, cost: quantity * cost, lots['QUANTITY'], lots['COST_BASIS']))
+        else:
+            # version 1, consecutive shares with the same cost and date are combined into lots
+            for share_dict in data['SHARES']:
+                position.add_share(share_dict['COST_BASIS'], share_dict['BUY_DATE'])
         return position
 
     def __init__(self, tag):
         self.tag = tag
-        self.shares = []
+        self.lots = deque()
+        self.num_shares = 0
         self.total_cost_basis = 0
+        self.current_price = None
+        self.day_change = 0
 
     def add_share(self, cost=None, date=None, num_shares=1):
         """
-        Adds a share to this position
+        Adds num_shares shares bought at cost on date to this position as one lot
         """
         if cost is None:
             self.update_price()
             cost = self.current_price
         if date is None:
             date = stock_scrape.get_date_str(stock_scrape.today())
-        for _ in range(num_shares):
-            self.shares.append(Share(self.tag + ":" + str(len(self.shares) + 1), cost, date))
-            self.total_cost_basis += cost
+        if num_shares <= 0:
+            return
+        last_lot = self.lots[-1] if self.lots else None
+        if last_lot and last_lot.cost_basis == cost and last_lot.buy_date == date:
+            last_lot.quantity += num_shares
+        else:
+            self.lots.append(Lot(num_shares, cost, date))
+        self.num_shares += num_shares
+        self.total_cost_basis += cost * num_shares
 
     def add_position(self, position):
         """
         Combines this position with another one if it has the same tag as this one.
         """
         if self.tag == position.tag:
-            self.shares.extend(position.shares)
+            for lot in position.lots:
+                self.add_share(lot.cost_basis, lot.buy_date, lot.quantity)
             return True
         return False
 
@@ -142,24 +234,63 @@ class Position():
         """
         Removes the oldest share from this position and returns it.
         """
-        return self.shares.pop(0)
+        lot = self.remove_shares(1)[0]
+        return Share(self.tag + ":1", lot.cost_basis, lot.buy_date)
+
+    def remove_shares(self, quantity):
+        """
+        Removes the oldest quantity shares from this position and returns them as a list of lots, oldest first.
+        Only the lots that are sold from are touched.
+        """
+        if quantity > self.num_shares:
+            raise ValueError(f'cannot remove {quantity} shares of {self.tag}, only {self.num_shares} are owned')
+        removed = []
+        while quantity > 0:
+            lot = self.lots[0]
+            if lot.quantity <= quantity:
+                self.lots.popleft()
+                removed.append(lot)
+            else:
+                lot.quantity -= quantity
+                removed.append(Lot(quantity, lot.cost_basis, lot.buy_date))
+            sold = removed[-1]
+            quantity -= sold.quantity
+            self.num_shares -= sold.quantity
+            self.total_cost_basis -= sold.quantity * sold.cost_basis
+        return removed
+
+    @property
+    def shares(self):
+        """
+        The shares in this position as a list of Share objects, oldest first.
+        This builds one object per share, prefer lots where possible.
+        """
+        shares = []
+        for lot in self.lots:
+            for _ in range(lot.quantity):
+                shares.append(Share(self.tag + ":" + str(len(shares) + 1), lot.cost_basis, lot.buy_date))
+        return shares
 
     def get_value(self):
         """
-        Updates the current price and returns the total value of this position
+        Returns the total value of this position, updating the current price if it has not been fetched yet
         """
-        self.update_price
+        if self.current_price is None:
+            self.update_price()
         return self.current_price * self.num_shares
 
     def update_price(self):
         """
         Updates the current price, and day change for this stock
         """
-        self.current_price, self.day_change = stock_scrape.get_current_price(self.tag, get_day_change=True) 
+        self.set_price(*stock_scrape.get_current_prices([self.tag])[self.tag])
 
-    @property
-    def num_shares(self):
-        return len(self.shares)
+    def set_price(self, current_price, day_change):
+        """
+        Sets the current price and day change for this stock from an already fetched quote
+        """
+        self.current_price = current_price
+        self.day_change = day_change
 
     def get_prev_week_data(self):
         """
@@ -171,17 +302,32 @@ class Position():
         """
         Returns a python dictionary representing this position.
 
-        Ex: 3 Disney shares bought on March 5, 2021 for $190 each would return:
-        {"TAG": "DIS", "NUM_SHARES": 3, "TOTAL_COST_BASIS": 570, "SHARES": [{"COST_BASIS": 190, "BUY_DATE": "2021/03/05"},
-                                                                      {"COST_BASIS": 190, "BUY_DATE": "2021/03/05"},
-                                                                      {"COST_BASIS": 190, "BUY_DATE": "2021/03/05"}]}
+        The lots are stored as columns so the size grows with the number of trades, not the number of shares.
+
+        Ex: 3 Disney shares bought on March 5, 2021 for $190 each and 2 more bought on March 8 for $192 would return:
+        {"TAG": "DIS", "NUM_SHARES": 5, "TOTAL_COST_BASIS": 954, "LOTS": {"QUANTITY": [3, 2],
+                                                                      "COST_BASIS": [190, 192],
+                                                                      "BUY_DATE": ["2021/03/05", "2021/03/08"]}}
         """
         return {"TAG": self.tag,
-                "SHARES": len(self.shares), 
+                "NUM_SHARES": self.num_shares, 
                 "TOTAL_COST_BASIS": self.total_cost_basis,
-                "SHARES": [share.get_save_dict() for share in self.shares],
+                "LOTS": {"QUANTITY": [lot.quantity for lot in self.lots],
+                         "COST_BASIS": [lot.cost_basis for lot in self.lots],
+                         "BUY_DATE": [lot.buy_date for lot in self.lots]},
                 }
 
+class Lot():
+    """
+    represents a group of shares of one company/index bought together for the same price on the same day
+    """
+    __slots__ = ('quantity', 'cost_basis', 'buy_date')
+
+    def __init__(self, quantity, cost_basis, buy_date):
+        self.quantity = quantity
+        self.cost_basis = cost_basis
+        self.buy_date = buy_date
+
 class Share():
     """
     represents exactly one share of one company/index
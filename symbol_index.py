@@ -0,0 +1,203 @@
+import json
+import os
+import re
+import threading
+import numpy as np
+
+from persistence import atomic_json_dump
+
+# bump when the layout of the index files changes so old indexes are rebuilt
+INDEX_VERSION = 2
+# keys are stored truncated to this many characters, longer searches are matched on their first KEY_LENGTH characters
+KEY_LENGTH = 16
+# the rank of a ticker match, name matches rank by the position of the word in the name after this
+TICKER_RANK = 0
+# symbol details other than the name, few values repeat across thousands of symbols so each is stored once
+# in a shared pool of strings and the table holds its position in the pool
+DETAIL_FIELDS = ('COUNTRY', 'IPO_YEAR', 'SECTOR', 'INDUSTRY')
+INDEX_FILES = ('keys', 'ids', 'ranks', 'tags', 'names', 'name_offsets', 'details', 'strings')
+
+def normalize(text):
+    """
+    Returns the upper case words in text as ascii bytes, ignoring punctuation
+    """
+    return [word.encode('ascii', 'ignore')[:KEY_LENGTH] for word in re.findall(r'[A-Z0-9]+', text.upper())]
+
+def source_stamp(path):
+    """
+    Returns what identifies a version of the symbols file, its size and modification time
+    """
+    stat = os.stat(path)
+    return {'VERSION': INDEX_VERSION, 'SIZE': stat.st_size, 'MTIME': stat.st_mtime_ns}
+
+def build_index(symbols):
+    """
+    Builds the index arrays from a dictionary of {tag: {"NAME": ...}} in the form of symbols.json.
+    Every ticker and every word of every company name is a key, sorted so a prefix is a contiguous range:
+    {"keys": key of each entry, "ids": the index in tags of the symbol each entry points to,
+     "ranks": TICKER_RANK for tickers, 1 + the position of the word for names, "tags": every ticker sorted,
+     "names": the utf-8 company names of the tags one after another, "name_offsets": where each name starts and ends,
+     "details": the position in strings of each of the DETAIL_FIELDS of each tag, "strings": each detail value once}
+    """
+    tags = sorted(symbols)
+    entries = []
+    for i, tag in enumerate(tags):
+        entries.append((tag.encode('ascii', 'ignore')[:KEY_LENGTH], i, TICKER_RANK))
+        words = normalize(symbols[tag].get('NAME', ''))
+        for position, word in enumerate(dict.fromkeys(words)):
+            entries.append((word, i, min(position + 1, 255)))
+    entries.sort()
+    names = [symbols[tag].get('NAME', '').encode('utf-8') for tag in tags]
+    strings = sorted({symbols[tag].get(field, '') for tag in tags for field in DETAIL_FIELDS})
+    codes = {string: i for i, string in enumerate(strings)}
+    return {'keys': np.array([key for key, _, _ in entries], dtype=f'S{KEY_LENGTH}'),
+            'ids': np.array([i for _, i, _ in entries], dtype=np.int32),
+            'ranks': np.array([rank for _, _, rank in entries], dtype=np.uint8),
+            'tags': np.array(tags, dtype='S'),
+            'names': np.frombuffer(b''.join(names), dtype=np.uint8),
+            'name_offsets': np.cumsum([0] + [len(name) for name in names], dtype=np.int64),
+            'details': np.array([[codes[symbols[tag].get(field, '')] for field in DETAIL_FIELDS] for tag in tags],
+                                dtype=np.uint16).reshape(len(tags), len(DETAIL_FIELDS)),
+            'strings': np.array(strings, dtype='U')}
+
+class SymbolIndex():
+    """
+    A search index and read only table of the symbols in a symbols.json file, saved as numpy arrays in directory
+    and memory mapped, so opening it costs the same however many symbols there are.
+    Nothing is read until the first search or lookup, and the index is only rebuilt when the symbols file changes.
+    """
+    def __init__(self, source_path, directory):
+        self.source_path = source_path
+        self.directory = directory
+        self.arrays = None
+        self.lock = threading.Lock()
+        # the last word matched and its range of keys, a longer word starting with it only has to search that range
+        self.last_range = (None, 0, 0)
+
+    def stamp_path(self):
+        return os.path.join(self.directory, 'source.json')
+
+    def array_path(self, name):
+        return os.path.join(self.directory, name + '.npy')
+
+    def load(self):
+        """
+        Opens the index, rebuilding it first if it is missing or older than the symbols file
+        """
+        with self.lock:
+            if self.arrays is not None:
+                return self.arrays
+            stamp = source_stamp(self.source_path)
+            try:
+                with open(self.stamp_path(), 'r') as stamp_file:
+                    current = json.load(stamp_file) == stamp
+            except (OSError, ValueError):
+                current = False
+            if not current:
+                self.rebuild(stamp)
+            self.arrays = {name: np.load(self.array_path(name), mmap_mode='r') for name in INDEX_FILES}
+            return self.arrays
+
+    def rebuild(self, stamp):
+        """
+        Builds the index from the symbols file and saves it, the stamp is written last so an interrupted
+        build is rebuilt next time
+        """
+        with open(self.source_path, 'r') as symbol_file:
+            arrays = build_index(json.load(symbol_file))
+        os.makedirs(self.directory, exist_ok=True)
+        for name, array in arrays.items():
+            temp_path = self.array_path(name + '.tmp')
+            np.save(temp_path, array)
+            os.replace(temp_path, self.array_path(name))
+        atomic_json_dump(stamp, self.stamp_path())
+
+    def key_range(self, word):
+        """
+        Returns the (start, end) range of keys starting with word. When word extends the last word looked up,
+        as it does while typing, only the range of the last word is searched.
+        """
+        keys = self.load()['keys']
+        last_word, low, high = self.last_range
+        if last_word is None or not word.startswith(last_word):
+            low, high = 0, len(keys)
+        start = low + int(np.searchsorted(keys[low:high], word, 'left'))
+        end = low + int(np.searchsorted(keys[low:high], word + b'\xff', 'left'))
+        self.last_range = (word, start, end)
+        return start, end
+
+    def match(self, word):
+        """
+        Returns a dictionary mapping the id of every symbol with a ticker or name word starting with word
+        to its best rank
+        """
+        start, end = self.key_range(word)
+        arrays = self.arrays
+        ids, ranks = np.asarray(arrays['ids'][start:end]), np.asarray(arrays['ranks'][start:end], dtype=np.int32)
+        order = np.lexsort((ids, ranks))
+        ids, first = np.unique(ids[order], return_index=True)
+        return dict(zip(ids.tolist(), ranks[order][first].tolist()))
+
+    def search(self, text, limit=50):
+        """
+        Returns up to limit tickers matching text, best first. A ticker matches if it starts with text as typed,
+        punctuation included, or if each word of text starts its ticker or a word of its company name.
+        An exact ticker comes first, then tickers starting with text, then ticker matches on each word, then names
+        matching on earlier words, then alphabetical order.
+        """
+        query = text.strip().upper().encode('ascii', 'ignore')[:KEY_LENGTH]
+        if not query:
+            return []
+        words = normalize(text)
+        matches, tickers = {}, set()
+        if words:
+            matches = self.match(words[0])
+            for word in words[1:]:
+                other = self.match(word)
+                matches = {i: rank + other[i] for i, rank in matches.items() if i in other}
+        if words != [query]:
+            # tickers like BF/A or BAC^K are matched whole, their punctuation splits them into words above
+            tickers = {i for i, rank in self.match(query).items() if rank == TICKER_RANK}
+            matches.update(dict.fromkeys(tickers, TICKER_RANK))
+        exact = self.find(query.decode('ascii'))
+        best = sorted(matches, key=lambda i: (i != exact, i not in tickers, matches[i], i))[:limit]
+        tags = self.arrays['tags']
+        return [tags[i].decode('ascii') for i in best]
+
+    def find(self, tag):
+        """
+        Returns the position of tag in the sorted tags, or None if it isn't a known symbol
+        """
+        tags = self.load()['tags']
+        key = tag.encode('ascii', 'ignore')
+        i = int(np.searchsorted(tags, key))
+        return i if i < len(tags) and tags[i] == key else None
+
+    def __contains__(self, tag):
+        return self.find(tag) is not None
+
+    def get_name(self, tag):
+        """
+        Returns the company name of tag, or None if it isn't a known symbol
+        """
+        i = self.find(tag)
+        if i is None:
+            return None
+        start, end = self.arrays['name_offsets'][i:i + 2]
+        return self.arrays['names'][start:end].tobytes().decode('utf-8')
+
+    def lookup(self, tag):
+        """
+        Returns the details of tag in the form stored in symbols.json, {"NAME": ..., "COUNTRY": ..., "IPO_YEAR": ...,
+        "SECTOR": ..., "INDUSTRY": ...}, or None if it isn't a known symbol
+        """
+        i = self.find(tag)
+        if i is None:
+            return None
+        strings = self.arrays['strings']
+        details = {field: str(strings[code]) for field, code in zip(DETAIL_FIELDS, self.arrays['details'][i])}
+        return {'NAME': self.get_name(tag), **details}
+
+    def close(self):
+        with self.lock:
+            self.arrays = None
@@ -0,0 +1,65 @@
+import numpy as np
+
+import stock_scrape
+
+def value_portfolio(portfolio, quotes=None):
+    """
+    Values every position in portfolio from one snapshot of quotes in a single vectorized pass.
+    quotes is a dictionary mapping tags to (price, day_change) tuples and is fetched in one batch if not given.
+    Positions missing from the snapshot keep their last known price.
+
+    The results are stored on the positions (current_price, day_change, market_value, gain_loss, weight) and the
+    portfolio (total_cost_basis, market_value, day_change, current_value, total_gain_loss), resetting its running
+    totals, and returned as a dictionary of arrays
+    in the order of portfolio.positions:
+    {"TAGS": [...], "QUANTITY": array, "COST_BASIS": array, "PRICE": array, "MARKET_VALUE": array,
+     "DAY_CHANGE": array, "GAIN_LOSS": array, "WEIGHT": array}
+    """
+    positions = portfolio.positions
+    tags = [position.tag for position in positions]
+    if quotes is None:
+        quotes = stock_scrape.get_current_prices(tags)
+    count = len(positions)
+    last_quotes = [(position.current_price or 0, position.day_change or 0) for position in positions]
+    snapshot = [quotes.get(tag, last_quote) for tag, last_quote in zip(tags, last_quotes)]
+
+    quantities = np.fromiter((position.num_shares for position in positions), dtype=float, count=count)
+    cost_bases = np.fromiter((position.total_cost_basis for position in positions), dtype=float, count=count)
+    prices = np.fromiter((price for price, _ in snapshot), dtype=float, count=count)
+    price_changes = np.fromiter((day_change for _, day_change in snapshot), dtype=float, count=count)
+
+    market_values = quantities * prices
+    day_changes = quantities * price_changes
+    gain_loss = market_values - cost_bases
+    market_value = float(market_values.sum())
+    weights = market_values / market_value if market_value else np.zeros(count)
+
+    for i, position in enumerate(positions):
+        position.set_price(*snapshot[i])
+        position.market_value = float(market_values[i])
+        position.gain_loss = float(gain_loss[i])
+        position.weight = float(weights[i])
+    portfolio.total_cost_basis = float(cost_bases.sum())
+    portfolio.market_value = market_value
+    portfolio.day_change = float(day_changes.sum())
+    portfolio.update_totals()
+
+    return {"TAGS": tags, "QUANTITY": quantities, "COST_BASIS": cost_bases, "PRICE": prices,
+            "MARKET_VALUE": market_values, "DAY_CHANGE": day_changes, "GAIN_LOSS": gain_loss, "WEIGHT": weights}
+
+def portfolio_tags(portfolios):
+    """
+    Returns the tags held across all of portfolios, each one once, in the order they are first seen
+    """
+    return list(dict.fromkeys(tag for portfolio in portfolios for tag in portfolio.position_index))
+
+def value_portfolios(portfolios, quotes=None):
+    """
+    Values every portfolio in portfolios against one shared snapshot of quotes, see value_portfolio.
+    If quotes isn't given every tag held by any of the portfolios is fetched once in one batch,
+    so the cost of revaluing grows with the number of different tags, not the number of portfolios.
+    Returns a list with the result of value_portfolio for each portfolio.
+    """
+    if quotes is None:
+        quotes = stock_scrape.get_current_prices(portfolio_tags(portfolios))
+    return [value_portfolio(portfolio, quotes) for portfolio in portfolios]